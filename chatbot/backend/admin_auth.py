@@ -0,0 +1,22 @@
+# admin_auth.py
+"""
+管理接口的访问控制：会话列表、worker 扩缩容等只对持有 ADMIN_TOKEN 的调用方开放。
+
+thread_id 就是会话的访问凭证（服务端签发的 128 位随机数），谁拿到它就能读取、删除对应的会话，
+所以列出全部 thread_id 的接口不能匿名访问。未设置 ADMIN_TOKEN 时管理接口全部关闭。
+"""
+import hmac
+import os
+
+from fastapi import Header, HTTPException
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+ADMIN_HEADER = "X-Admin-Token"
+
+
+def require_admin(x_admin_token: str | None = Header(default=None)):
+    """FastAPI dependency: 403 unless the request carries the configured admin token."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (set ADMIN_TOKEN)")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Admin token required")
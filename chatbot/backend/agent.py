@@ -17,73 +17,203 @@ if "DEEPSEEK_API_KEY" not in os.environ:
 ##---------------------------------------------------
 ## (1) Define Model & Memory
 ##---------------------------------------------------
-# from langchain.tools import tool
 from langchain.chat_models import init_chat_model
 from langgraph.checkpoint.memory import InMemorySaver
 
-llm = init_chat_model(
-    model="deepseek-chat",
-    temperature=0.1,  # A higher number makes responses more creative; lower ones make them more deterministic.
-    timeout=30,
-    max_tokens=1000,
-    max_retries=2
-)
+from model_tiers import FAST_TIER, FULL_TIER, MODEL_TIERS
+
+# 完整档：分类、工具调用和复杂问题；快速档：普通路径上的简单闲聊
+llm = init_chat_model(**MODEL_TIERS[FULL_TIER])
+llm_fast = init_chat_model(**MODEL_TIERS[FAST_TIER])
 
-checkpointer = InMemorySaver()
+from checkpoint_serde import FastCheckpointSerializer
+
+# 每个 superstep 都会序列化完整的消息历史；默认用紧凑的二进制格式（CHECKPOINT_SERIALIZER=default 换回内置的）
+if os.environ.get("CHECKPOINT_SERIALIZER", "fast") == "fast":
+    checkpointer = InMemorySaver(serde=FastCheckpointSerializer())
+else:
+    checkpointer = InMemorySaver()
 
 ##---------------------------------------------------
 ## (2) Define tools
 ##---------------------------------------------------
+from langchain.tools import tool
 from langchain_tavily import TavilySearch
 
+from bm25_index import BM25Index
+from vector_store import MmapVectorStore
+
 tavily_tool = TavilySearch(max_results=2)
 
+# 本地文档向量库（离线 embedding + 内存映射的 float16 向量），用 vector_store.py ingest 导入文档
+vector_store = MmapVectorStore(os.environ.get("VECTOR_STORE_DIR", "./vector_store"))
+VECTOR_STORE_N_PROBE = int(os.environ.get("VECTOR_STORE_N_PROBE", "8"))
+
+
+@tool
+def local_docs_search(query: str) -> str:
+    """Search our own internal documents. Prefer this over web search for questions about internal knowledge.
+
+    Args:
+        query: the search query
+    """
+    vector_store.refresh()  # 服务运行期间用 vector_store.py ingest 新导入的文档
+    if len(vector_store) == 0:
+        return "本地文档库为空"
+    hits = vector_store.similarity_search([query], k=4, n_probe=VECTOR_STORE_N_PROBE)[0]
+    return "\n\n".join(
+        f"[{hit['score']:.3f}] {hit['metadata'].get('source', '')}\n{hit['text']}" for hit in hits
+    )
+
+
+# 本地文档倒排索引（BM25），用 bm25_index.py ingest 流式导入文档（导入、合并都在 CLI 进程里进行）；
+# 服务端只读打开，查询前检查 manifest 是否有新提交
+bm25_index = BM25Index(os.environ.get("BM25_INDEX_DIR", "./bm25_index"), read_only=True)
+
+
+@tool
+def local_docs_keyword_search(query: str) -> str:
+    """Keyword (BM25) search over our own internal documents. Use it for exact names, terms, error codes or numbers.
+
+    Args:
+        query: the keywords to search for
+    """
+    bm25_index.refresh()
+    hits = bm25_index.search(query, k=4)
+    if not hits:
+        return "本地文档中没有匹配的内容"
+    return "\n\n".join(
+        f"[{hit['score']:.3f}] {hit['metadata'].get('source', '')}\n{hit['text']}" for hit in hits
+    )
+
+
+# 每个工具一个截止时间；联网搜索另外加熔断器，下游异常时快速失败而不是拖住整条请求
+from circuit_breaker import OPEN, circuit_breakers, guard_tool, notify_degraded
+
+TOOL_DEADLINES = {
+    tavily_tool.name: float(os.environ.get("WEB_SEARCH_DEADLINE", "8")),
+    local_docs_search.name: 2.0,
+    local_docs_keyword_search.name: 2.0,
+}
+web_search_breaker = circuit_breakers.get(tavily_tool.name, failure_threshold=3, reset_timeout=30.0)
+
 # Augment the LLM with tools
-tools = [tavily_tool]
+tools = [
+    guard_tool(tavily_tool, TOOL_DEADLINES[tavily_tool.name], web_search_breaker),
+    guard_tool(local_docs_search, TOOL_DEADLINES[local_docs_search.name]),
+    guard_tool(local_docs_keyword_search, TOOL_DEADLINES[local_docs_keyword_search.name]),
+]
 tools_by_name = {tool.name: tool for tool in tools}
-llm_with_tools = llm.bind_tools(tools)
+
+# 所有上游调用都经过同一个限流调度器：交互式对话优先于时效性分类，分类优先于批量任务
+from llm_scheduler import CLASSIFIER, INTERACTIVE, ScheduledChatModel, extra_call_admission
+
+# 可选：对冲请求（LLM_HEDGING=1）。首 token 超过滚动 p95 TTFT 时发备份请求，谁先出 token 用谁。
+# 对冲包在调度器里面：排队等配额的时间不计入 TTFT；备份请求另外申请配额，正在限流时不对冲
+LLM_HEDGING = os.environ.get("LLM_HEDGING", "0") == "1"
+if LLM_HEDGING:
+    from hedging import hedge_stats
+
+
+def scheduled(name: str, model, priority: str) -> ScheduledChatModel:
+    if LLM_HEDGING:
+        model = hedge_stats.wrap(name, model, admit=extra_call_admission(model, priority))
+    return ScheduledChatModel(inner=model, priority=priority)
+
+
+llm_classifier = scheduled("is_time_sensitive_node", llm, CLASSIFIER)
+llm_with_tools = scheduled("llm_call_with_tools", llm.bind_tools(tools), INTERACTIVE)
+# 普通路径也带上同一份工具 schema（但禁止调用），两条路径的请求前缀一致，可以共享服务端缓存
+tier_models = {
+    FAST_TIER: scheduled(f"llm_call:{FAST_TIER}", llm_fast.bind_tools(tools, tool_choice="none"), INTERACTIVE),
+    FULL_TIER: scheduled(f"llm_call:{FULL_TIER}", llm.bind_tools(tools, tool_choice="none"), INTERACTIVE),
+}
 
 ##---------------------------------------------------
 ## (3) Define state
 ##---------------------------------------------------
-from langchain.messages import AnyMessage, SystemMessage
+from langchain.messages import AnyMessage, HumanMessage
 from typing_extensions import TypedDict, Annotated
 import operator
 
+from sse_stream import emit_event
+
+from model_tiers import choose_tier, model_tier_stats, needs_escalation, timed_invoke
+from prompt_assembly import PromptAssembler, prompt_cache_stats
+
 
 class MessagesState(TypedDict):
     messages: Annotated[list[AnyMessage], operator.add]
     llm_calls: int
     is_time_sensitive: bool
+    current_datetime: str  # 只用于本轮请求的动态上下文，不写入 messages
+
+
+# 静态前缀：所有对话请求共用同一个系统消息
+chat_prompt = PromptAssembler("你是一个对话机器人，用于测试各种LLM API，因为仅用于测试，回答问题时请简明扼要")
+classifier_prompt = PromptAssembler(
+    "你是一个对话机器人。请判断用户的问题是否涉及时效性（即答案会随时间变化），"
+    "如果是请回答 'YES'，否则回答 'NO'。只需输出'YES'或'NO'，不要输出其他内容。"
+)
 
 
 ##---------------------------------------------------
 ## (4) Define model node
 ##---------------------------------------------------
 def llm_call(state: dict):
-    print("Using LLM directly...")
-    # 添加系统消息
-    system_message = SystemMessage(
-        content="你是一个对话机器人，用于测试各种LLM API，因为仅用于测试，回答问题时请简明扼要"
-    )
-    # 将系统消息添加到messages列表的最前面
-    messages_with_system = [system_message] + state["messages"]
+    # 静态系统消息在前，会话历史在后
+    messages = chat_prompt.assemble(state["messages"])
+    tier = choose_tier(state["messages"])
+    print(f"Using LLM directly ({tier} tier)...")
+    try:
+        response = timed_invoke(tier, tier_models[tier], messages)
+        reason = needs_escalation(response) if tier == FAST_TIER else None
+    except Exception as e:
+        if tier != FAST_TIER:
+            raise
+        print(f"Fast tier failed: {e}")
+        reason = "error"
+    if reason:
+        # 快速档回答不可用：通知客户端丢弃已流式输出的内容，用完整档重答
+        print(f"Escalating to {FULL_TIER} tier: {reason}")
+        model_tier_stats.record_escalation(FAST_TIER, reason)
+        emit_event("tier_escalation", {"from": FAST_TIER, "to": FULL_TIER, "reason": reason})
+        response = timed_invoke(FULL_TIER, tier_models[FULL_TIER], messages)
+    prompt_cache_stats.record("llm_call", response)
     return {
-        "messages": [llm.invoke(messages_with_system)],
+        "messages": [response],
         "llm_calls": state.get('llm_calls', 0) + 1
     }
 
 
 def llm_call_with_tools(state: dict):
     print("Using LLM with tools...")
-    # 添加系统消息
-    system_message = SystemMessage(
-        content="你是一个对话机器人，用于测试各种LLM API，因为仅用于测试，回答问题时请简明扼要"
-    )
-    # 将系统消息添加到messages列表的最前面
-    messages_with_system = [system_message] + state["messages"]
+    # 当前时间属于动态内容，只临时追加到请求末尾，历史里不写入
+    dynamic_context = None
+    if state.get("current_datetime"):
+        dynamic_context = [f"当前日期和时间: {state['current_datetime']}"]
+    response = llm_with_tools.invoke(chat_prompt.assemble(state["messages"], dynamic_context))
+    prompt_cache_stats.record("llm_call_with_tools", response)
     return {
-        "messages": [llm_with_tools.invoke(messages_with_system)],
+        "messages": [response],
+        "llm_calls": state.get('llm_calls', 0) + 1
+    }
+
+
+def llm_call_degraded(state: dict):
+    """
+    联网搜索熔断时的降级回答：不带工具，只注入当前时间。
+    """
+    print("Web search unavailable, answering in degraded mode...")
+    notify_degraded(tavily_tool.name, "circuit_open")
+    dynamic_context = [
+        f"当前日期和时间: {state.get('current_datetime', '')}",
+        "联网搜索暂时不可用。请基于已有知识回答，并提醒用户信息可能不是最新的。",
+    ]
+    response = tier_models[FULL_TIER].invoke(chat_prompt.assemble(state["messages"], dynamic_context))
+    prompt_cache_stats.record("llm_call_degraded", response)
+    return {
+        "messages": [response],
         "llm_calls": state.get('llm_calls', 0) + 1
     }
 
@@ -97,20 +227,13 @@ def is_time_sensitive_node(state: MessagesState):
     """
     # 获取用户的最后一个消息
     question = state["messages"][-1].content
-    system_prompt = (
-        "你是一个对话机器人。请判断用户的问题是否涉及时效性（即答案会随时间变化），"
-        "如果是请回答 'YES'，否则回答 'NO'。只需输出'YES'或'NO'，不要输出其他内容。"
-    )
-    prompt = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": question}
-    ]
-    result = llm.invoke(prompt)
+    result = llm_classifier.invoke(classifier_prompt.assemble([HumanMessage(content=question)]))
+    prompt_cache_stats.record("is_time_sensitive_node", result)
     answer = result.content.strip().upper()
     # print the question and the answer
     print(f"Question: {question} | Is time-sensitive? {answer}")
+    # 不返回 messages：messages 使用 operator.add 合并，原样返回会让历史重复一份
     return {
-        "messages": state["messages"],
         "llm_calls": state.get('llm_calls', 0) + 1,
         "is_time_sensitive": answer == "YES"
     }
@@ -118,7 +241,7 @@ def is_time_sensitive_node(state: MessagesState):
 
 def get_current_datetime_node(state: MessagesState):
     """
-    获取当前的日期和时间，并将其作为新消息添加到messages列表中。
+    获取当前的日期和时间，作为本轮请求的动态上下文（不写入messages，保持历史前缀稳定）。
     """
     # 获取当前日期时间
     current_time = datetime.now()
@@ -127,22 +250,31 @@ def get_current_datetime_node(state: MessagesState):
     # 打印获取到的时间
     print(f"Current datetime: {formatted_time}")
 
-    # 创建包含日期时间信息的系统消息
-    datetime_message = SystemMessage(
-        content=f"当前日期和时间: {formatted_time}"
-    )
-
-    # 返回更新后的state，将日期时间消息添加到messages列表
-    return {
-        "messages": state["messages"] + [datetime_message],
-        "llm_calls": state.get('llm_calls', 0),
-        "is_time_sensitive": state.get('is_time_sensitive', False)
-    }
+    return {"current_datetime": formatted_time}
 
 
+from langchain_core.runnables import RunnableConfig
 from langgraph.prebuilt import ToolNode, tools_condition
 
+from tool_results import condense_tool_messages
+
 tool_node = ToolNode(tools=tools)
+# 每条工具结果交给模型前的 token 预算；完整结果保存在 tool_result_store 中
+TOOL_RESULT_TOKEN_BUDGET = int(os.environ.get("TOOL_RESULT_TOKEN_BUDGET", "400"))
+
+
+def tool_node_with_condensation(state: MessagesState, config: RunnableConfig):
+    """
+    执行工具，并把每条工具结果精简到 TOOL_RESULT_TOKEN_BUDGET 以内再写入 messages。
+    精简后的结果既用于本轮的工具循环，也是会话历史里保存的版本。
+    """
+    result = tool_node.invoke(state, config)
+    # 相关性按用户问题 + 模型给出的工具参数（搜索词）计算
+    question = next((m.content for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), "")
+    tool_args = " ".join(str(value) for call in state["messages"][-1].tool_calls for value in call["args"].values())
+    thread_id = config.get("configurable", {}).get("thread_id")
+    return {"messages": condense_tool_messages(result["messages"], f"{question} {tool_args}",
+                                               TOOL_RESULT_TOKEN_BUDGET, thread_id)}
 
 ##---------------------------------------------------
 ## (6) Build and compile the agent
@@ -154,7 +286,11 @@ graph_builder.add_node("is_time_sensitive_node", is_time_sensitive_node)
 graph_builder.add_node("get_current_datetime_node", get_current_datetime_node)
 graph_builder.add_node("llm_call_with_tools", llm_call_with_tools)
 graph_builder.add_node("llm_call", llm_call)
-graph_builder.add_node("tool_node", tool_node)
+graph_builder.add_node("llm_call_degraded", llm_call_degraded)
+graph_builder.add_node("tool_node", tool_node_with_condensation)
+
+# 输出会流式发给客户端的节点；其余节点（时效性分类器等）的模型输出只在图内部使用
+CLIENT_STREAM_NODES = frozenset({"llm_call", "llm_call_with_tools", "llm_call_degraded"})
 
 
 # 定义条件函数来决定下一步
@@ -181,8 +317,25 @@ graph_builder.add_conditional_edges(
     }
 )
 
-# 时效性问题路径：获取时间 -> 使用带工具的LLM
-graph_builder.add_edge("get_current_datetime_node", "llm_call_with_tools")
+def decide_web_search_route(state: MessagesState):
+    """
+    联网搜索熔断（open）时直接降级回答；half-open 时照常走工具路径，让探测请求通过
+    """
+    if web_search_breaker.state == OPEN:
+        return "degraded"
+    return "with_tools"
+
+
+# 时效性问题路径：获取时间 -> 使用带工具的LLM（搜索熔断时 -> 降级回答）
+graph_builder.add_conditional_edges(
+    "get_current_datetime_node",
+    decide_web_search_route,
+    {
+        "with_tools": "llm_call_with_tools",
+        "degraded": "llm_call_degraded"
+    }
+)
+graph_builder.add_edge("llm_call_degraded", END)
 
 # 对于带工具的LLM，使用tools_condition来决定是否需要调用工具
 graph_builder.add_conditional_edges(
@@ -0,0 +1,489 @@
+# bm25_index.py
+## pip install numpy
+"""
+本地文档的流式导入 + 磁盘倒排索引（BM25 打分）。
+
+导入链路全部是生成器：文件遍历 -> 按段落读取 -> 切块 -> 分词，内存里只保留一个待刷盘的缓冲段。
+缓冲段写满后落成只追加的 segment 目录，后台线程把小 segment 合并成大 segment。
+
+目录结构（BM25_INDEX_DIR）：
+- docs.jsonl        : 每行一个 {"text": ..., "metadata": {...}}，只追加
+- manifest.json     : 当前生效的 segment 列表 + docs.jsonl 的有效长度（原子替换）
+- seg_000001/       : terms.json（排好序的词表）, term_offsets.npy, postings_doc.npy,
+                      postings_tf.npy, doc_lens.npy, doc_offsets.npy（全部 .npy 以 mmap 方式读取）
+"""
+import json
+import os
+import re
+import shutil
+import threading
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+K1 = 1.2
+B = 0.75
+TEXT_EXTENSIONS = (".txt", ".md", ".markdown", ".rst", ".json", ".jsonl", ".csv", ".html")
+
+
+##---------------------------------------------------
+## (1) Streaming reader, chunker and tokenizer
+##---------------------------------------------------
+def iter_files(paths, extensions=TEXT_EXTENSIONS):
+    """Yield text file paths under `paths` (files or directories), depth-first."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(extensions):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def iter_paragraphs(file_path):
+    """Yield blank-line separated paragraphs of a file without reading it whole."""
+    lines = []
+    with open(file_path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                lines.append(line)
+            elif lines:
+                yield "\n".join(lines)
+                lines = []
+    if lines:
+        yield "\n".join(lines)
+
+
+def iter_chunks(paths, max_chars=500):
+    """Yield (text, metadata) chunks of at most `max_chars`, packing whole paragraphs when possible."""
+    for file_path in iter_files(paths):
+        current, n = "", 0
+        for para in iter_paragraphs(file_path):
+            while len(para) > max_chars:
+                if current:
+                    yield current, {"source": file_path, "chunk": n}
+                    current, n = "", n + 1
+                yield para[:max_chars], {"source": file_path, "chunk": n}
+                para, n = para[max_chars:], n + 1
+            if current and len(current) + len(para) + 1 > max_chars:
+                yield current, {"source": file_path, "chunk": n}
+                current, n = "", n + 1
+            current = f"{current}\n{para}" if current else para
+        if current:
+            yield current, {"source": file_path, "chunk": n}
+
+
+_TOKEN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[a-z0-9]+(?:[._'-][a-z0-9]+)*")
+_CJK_START = "\u3400"
+
+
+def tokenize(text):
+    """
+    中英文混合分词：英文/数字按单词切分并转小写；中文连续片段输出单字 + 相邻二字组合。
+    不依赖分词词典，对领域新词也能召回。
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        run = match.group()
+        if run[0] >= _CJK_START:
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+##---------------------------------------------------
+## (2) Segments
+##---------------------------------------------------
+class Segment:
+    """Read-only, memory-mapped view of one on-disk segment."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "terms.json"), encoding="utf-8") as f:
+            self.terms = json.load(f)
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.term_offsets = load("term_offsets.npy")
+        self.postings_doc = load("postings_doc.npy")
+        self.postings_tf = load("postings_tf.npy")
+        self.doc_lens = load("doc_lens.npy")
+        self.doc_offsets = load("doc_offsets.npy")
+        self.n_docs = len(self.doc_lens)
+        self.total_len = int(self.doc_lens.sum())
+
+    def _term_id(self, term):
+        # 词表已排序，二分查找比常驻一个 dict 省一半内存
+        i = bisect_left(self.terms, term)
+        return i if i < len(self.terms) and self.terms[i] == term else None
+
+    def postings(self, term):
+        i = self._term_id(term)
+        if i is None:
+            return None
+        start, end = self.term_offsets[i], self.term_offsets[i + 1]
+        return self.postings_doc[start:end], self.postings_tf[start:end]
+
+    def df(self, term):
+        i = self._term_id(term)
+        return 0 if i is None else int(self.term_offsets[i + 1] - self.term_offsets[i])
+
+
+def write_segment(path, terms, term_offsets, postings_doc, postings_tf, doc_lens, doc_offsets):
+    """Write a segment into a temp dir and rename it into place."""
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    with open(os.path.join(tmp_path, "terms.json"), "w", encoding="utf-8") as f:
+        json.dump(terms, f, ensure_ascii=False)
+    np.save(os.path.join(tmp_path, "term_offsets.npy"), np.asarray(term_offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "postings_doc.npy"), np.asarray(postings_doc, dtype=np.int32))
+    np.save(os.path.join(tmp_path, "postings_tf.npy"), np.asarray(postings_tf, dtype=np.int32))
+    np.save(os.path.join(tmp_path, "doc_lens.npy"), np.asarray(doc_lens, dtype=np.int32))
+    np.save(os.path.join(tmp_path, "doc_offsets.npy"), np.asarray(doc_offsets, dtype=np.int64))
+    os.replace(tmp_path, path)
+    return Segment(path)
+
+
+def merge_segments(path, segments):
+    """
+    合并多个 segment。每个 segment 内部 postings 已按 (term, doc) 排序，且各 segment 按文档顺序拼接，
+    所以只需对合并后的 term 列做一次稳定排序即可得到 (term, doc) 有序的 postings。
+    """
+    terms = sorted(set().union(*(seg.terms for seg in segments)))
+    term_ids = {term: i for i, term in enumerate(terms)}
+    all_terms, all_docs = [], []
+    doc_base = 0
+    for seg in segments:
+        local_to_merged = np.fromiter((term_ids[t] for t in seg.terms), dtype=np.int32, count=len(seg.terms))
+        all_terms.append(np.repeat(local_to_merged, np.diff(seg.term_offsets)))
+        all_docs.append(seg.postings_doc + np.int32(doc_base))
+        doc_base += seg.n_docs
+    del term_ids
+    merged_terms = np.concatenate(all_terms)
+    del all_terms
+    order = np.argsort(merged_terms, kind="stable")
+    term_offsets = np.searchsorted(merged_terms[order], np.arange(len(terms) + 1))
+    del merged_terms
+    return write_segment(
+        path, terms, term_offsets,
+        np.concatenate(all_docs)[order],
+        np.concatenate([seg.postings_tf for seg in segments])[order],
+        np.concatenate([seg.doc_lens for seg in segments]),
+        np.concatenate([seg.doc_offsets for seg in segments]),
+    )
+
+
+##---------------------------------------------------
+## (3) Index: buffered writer + background merger + BM25 search
+##---------------------------------------------------
+class BM25Index:
+    """Append-only segmented inverted index with BM25 scoring."""
+
+    def __init__(self, path, flush_postings=2_000_000, merge_factor=8, background_merge=True, read_only=False):
+        """
+        `read_only=True` is for the server: it only searches, never touches the directory
+        (no orphan cleanup, no merger) and picks up segments committed by the ingest CLI via `refresh()`.
+        """
+        self.path = path
+        self.flush_postings = flush_postings
+        self.merge_factor = merge_factor
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+        self._docs_path = os.path.join(path, "docs.jsonl")
+        self._manifest_path = os.path.join(path, "manifest.json")
+        self._lock = threading.Lock()  # 保护 segment 列表和 manifest
+
+        self.segments = []
+        self._docs_end = 0
+        self._next_segment = 1
+        self._manifest_version = None
+        self.refresh()
+        if not read_only:
+            self._remove_orphans()
+        self._reset_buffer()
+
+        self._merge_wakeup = threading.Event()
+        self._closed = False
+        self._merger = None
+        if background_merge and not read_only:
+            self._merger = threading.Thread(target=self._merge_loop, name="bm25-merger", daemon=True)
+            self._merger.start()
+
+    def __len__(self):
+        return sum(seg.n_docs for seg in self.segments) + len(self._buf_lens)
+
+    def _reset_buffer(self):
+        # 缓冲段用扁平数组保存 (term id, doc, tf) 三元组，刷盘时再按 term 排序
+        self._buf_term_ids = {}
+        self._buf_terms = array("i")
+        self._buf_docs = array("i")
+        self._buf_tfs = array("i")
+        self._buf_lens = array("i")
+        self._buf_offsets = array("q")
+
+    def _remove_orphans(self):
+        """Drop segment dirs not in the manifest (e.g. left over from an interrupted merge)."""
+        live = {seg.name for seg in self.segments}
+        for name in os.listdir(self.path):
+            if name.startswith("seg_") and name not in live:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def refresh(self):
+        """Reload the manifest if it changed on disk (e.g. the ingest CLI committed or merged segments)."""
+        try:
+            stat = os.stat(self._manifest_path)
+        except FileNotFoundError:
+            return False
+        # manifest 通过 os.replace 原子替换，inode + mtime 变化即有新提交
+        version = (stat.st_ino, stat.st_mtime_ns)
+        if version == self._manifest_version:
+            return False
+        with open(self._manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        loaded = {seg.name: seg for seg in self.segments}
+        try:
+            segments = [loaded.get(name) or Segment(os.path.join(self.path, name)) for name in manifest["segments"]]
+        except FileNotFoundError:
+            # 读 manifest 与打开 segment 之间它又被合并删除了：保留当前快照，下次再试
+            return False
+        with self._lock:
+            self.segments = segments
+            self._docs_end = manifest["docs_end"]
+            self._next_segment = manifest["next_segment"]
+            self._manifest_version = version
+        return True
+
+    def _write_manifest(self):
+        manifest = {
+            "segments": [seg.name for seg in self.segments],
+            "docs_end": self._docs_end,
+            "next_segment": self._next_segment,
+        }
+        tmp_path = self._manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._manifest_path)
+
+    def _new_segment_path(self):
+        with self._lock:
+            name = f"seg_{self._next_segment:06d}"
+            self._next_segment += 1
+        return os.path.join(self.path, name)
+
+    ## ---- ingestion ----
+    def add_documents(self, docs):
+        """Stream (text, metadata) pairs into the index; returns the number added."""
+        if self.read_only:
+            raise RuntimeError(f"BM25 index at {self.path} is opened read-only")
+        added = 0
+        with open(self._docs_path, "ab") as f:
+            # 丢弃 manifest 之后的未提交数据（上次中断时的缓冲段）
+            f.truncate(self._docs_end)
+            pos = self._docs_end
+            for text, metadata in docs:
+                tokens = tokenize(text)
+                counts = {}
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+                term_ids = self._buf_term_ids
+                self._buf_terms.extend(term_ids.setdefault(term, len(term_ids)) for term in counts)
+                self._buf_docs.extend([len(self._buf_lens)] * len(counts))
+                self._buf_tfs.extend(counts.values())
+                self._buf_lens.append(len(tokens))
+                self._buf_offsets.append(pos)
+                line = (json.dumps({"text": text, "metadata": metadata}, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                pos += len(line)
+                added += 1
+                if len(self._buf_docs) >= self.flush_postings:
+                    f.flush()
+                    self._flush_buffer(pos)
+        self.flush()
+        return added
+
+    def flush(self):
+        if len(self._buf_lens):
+            self._flush_buffer(os.path.getsize(self._docs_path))
+
+    def _flush_buffer(self, docs_end):
+        terms = sorted(self._buf_term_ids)
+        rank = np.empty(len(terms), dtype=np.int64)
+        rank[[self._buf_term_ids[t] for t in terms]] = np.arange(len(terms))
+        term_col = rank[np.frombuffer(self._buf_terms, dtype=np.int32)]
+        doc_col = np.frombuffer(self._buf_docs, dtype=np.int32)
+        order = np.lexsort((doc_col, term_col))
+        term_offsets = np.searchsorted(term_col[order], np.arange(len(terms) + 1))
+        segment = write_segment(
+            self._new_segment_path(), terms, term_offsets, doc_col[order],
+            np.frombuffer(self._buf_tfs, dtype=np.int32)[order],
+            np.frombuffer(self._buf_lens, dtype=np.int32), np.frombuffer(self._buf_offsets, dtype=np.int64),
+        )
+        with self._lock:
+            self.segments = self.segments + [segment]
+            self._docs_end = docs_end
+            self._write_manifest()
+        self._reset_buffer()
+        if self._merger is not None:
+            self._merge_wakeup.set()
+        else:
+            self.maybe_merge()
+
+    ## ---- merging ----
+    def maybe_merge(self):
+        """Merge the `merge_factor` smallest segments while there are too many."""
+        while len(self.segments) > self.merge_factor:
+            victims = sorted(self.segments, key=lambda seg: seg.n_docs)[:self.merge_factor]
+            merged = merge_segments(self._new_segment_path(), victims)
+            victim_names = {seg.name for seg in victims}
+            with self._lock:
+                self.segments = [seg for seg in self.segments if seg.name not in victim_names] + [merged]
+                self._write_manifest()
+            # 已 mmap 的旧文件在 Linux 上删除后仍可被正在执行的查询读取
+            for seg in victims:
+                shutil.rmtree(seg.path, ignore_errors=True)
+            print(f"[bm25] merged {len(victims)} segments -> {merged.name} ({merged.n_docs} docs)")
+
+    def _merge_loop(self):
+        while True:
+            self._merge_wakeup.wait()
+            self._merge_wakeup.clear()
+            # 关闭时也先把排队中的合并做完再退出，不留下超过 merge_factor 的段
+            try:
+                self.maybe_merge()
+            except Exception as e:
+                print(f"[bm25] background merge failed: {e}")
+            if self._closed:
+                return
+
+    def close(self):
+        """Flush the buffer and wait for the merger to finish any queued or running merge."""
+        self.flush()
+        self._closed = True
+        if self._merger is not None:
+            self._merge_wakeup.set()
+            self._merger.join()
+            self._merger = None
+
+    ## ---- search ----
+    def search(self, query, k=5):
+        """Return up to `k` {"text", "metadata", "score"} hits ranked by BM25."""
+        segments = self.segments  # 快照，合并线程替换列表不影响本次查询
+        terms = set(tokenize(query))
+        n_docs = sum(seg.n_docs for seg in segments)
+        if not terms or n_docs == 0:
+            return []
+        avgdl = sum(seg.total_len for seg in segments) / n_docs
+        idf = {}
+        for term in terms:
+            df = sum(seg.df(term) for seg in segments)
+            if df:
+                idf[term] = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+
+        candidates = []  # (score, segment, local doc)
+        for seg in segments:
+            scores = None
+            for term, w in idf.items():
+                postings = seg.postings(term)
+                if postings is None:
+                    continue
+                docs, tfs = postings
+                tfs = np.asarray(tfs, dtype=np.float32)
+                if scores is None:
+                    scores = np.zeros(seg.n_docs, dtype=np.float32)
+                norm = K1 * (1.0 - B + B * np.asarray(seg.doc_lens[docs], dtype=np.float32) / avgdl)
+                scores[docs] += np.float32(w) * tfs * (K1 + 1.0) / (tfs + norm)
+            if scores is None:
+                continue
+            kk = min(k, seg.n_docs)
+            top = np.argpartition(-scores, kk - 1)[:kk]
+            candidates.extend((float(scores[i]), seg, int(i)) for i in top if scores[i] > 0)
+
+        candidates.sort(key=lambda c: -c[0])
+        hits = []
+        with open(self._docs_path, "rb") as f:
+            for score, seg, doc in candidates[:k]:
+                f.seek(int(seg.doc_offsets[doc]))
+                hit = json.loads(f.readline())
+                hit["score"] = score
+                hits.append(hit)
+        return hits
+
+
+if __name__ == "__main__":
+    # python bm25_index.py ingest ../docs
+    # python bm25_index.py query "问题"
+    # python bm25_index.py bench-ingest --docs 200000
+    # python bm25_index.py bench-query --docs 200000
+    import argparse
+    import itertools
+    import random
+    import resource
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description="Streaming BM25 index for local documents")
+    parser.add_argument("command", choices=["ingest", "query", "bench-ingest", "bench-query"])
+    parser.add_argument("args", nargs="*")
+    parser.add_argument("--dir", default=os.environ.get("BM25_INDEX_DIR", "./bm25_index"))
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--docs", type=int, default=200_000)
+    parser.add_argument("--queries", type=int, default=500)
+    opts = parser.parse_args()
+
+    def synthetic_docs(n, seed=0):
+        """Generator of mixed Chinese/English chunks drawn from a Zipf-distributed vocabulary."""
+        rnd = random.Random(seed)
+        chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+        vocab = ["".join(rnd.choices(chars, k=rnd.randint(1, 4))) for _ in range(30000)]
+        vocab += [f"term{i}" for i in range(5000)]
+        rnd.shuffle(vocab)
+        cum_weights = list(itertools.accumulate(1.0 / (i + 1) for i in range(len(vocab))))
+        for i in range(n):
+            words = rnd.choices(vocab, cum_weights=cum_weights, k=rnd.randint(40, 150))
+            yield " ".join(words), {"source": "synthetic", "chunk": i}
+
+    def peak_rss_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    if opts.command in ("bench-ingest", "bench-query"):
+        with tempfile.TemporaryDirectory() as d:
+            index = BM25Index(d)
+            rss_before = peak_rss_mb()
+            t0 = time.perf_counter()
+            index.add_documents(synthetic_docs(opts.docs))
+            index.close()
+            assert len(index.segments) <= index.merge_factor, "close() left segments unmerged"
+            elapsed = time.perf_counter() - t0
+            print(f"ingest: {opts.docs} docs in {elapsed:.1f}s ({opts.docs / elapsed:.0f} docs/sec), "
+                  f"{len(index.segments)} segments, peak RSS {peak_rss_mb():.0f} MB (start {rss_before:.0f} MB)")
+            if opts.command == "bench-query":
+                rnd = random.Random(1)
+                queries = [text[rnd.randint(0, 60):][:rnd.randint(2, 8)] for text, _ in synthetic_docs(opts.queries, seed=2)]
+                for q in queries[:10]:
+                    index.search(q, k=opts.k)
+                latencies = []
+                for q in queries:
+                    t0 = time.perf_counter()
+                    index.search(q, k=opts.k)
+                    latencies.append((time.perf_counter() - t0) * 1000)
+                latencies.sort()
+                pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+                print(f"query: n={len(latencies)} p50={pct(0.5):.2f} ms p95={pct(0.95):.2f} ms p99={pct(0.99):.2f} ms")
+    else:
+        index = BM25Index(opts.dir, background_merge=False)
+        if opts.command == "ingest":
+            t0 = time.perf_counter()
+            added = index.add_documents(iter_chunks(opts.args))
+            index.close()
+            print(f"ingested {added} chunks in {time.perf_counter() - t0:.1f}s, total {len(index)} chunks, "
+                  f"peak RSS {peak_rss_mb():.0f} MB")
+        else:
+            for hit in index.search(" ".join(opts.args), k=opts.k):
+                print(f"[{hit['score']:.3f}] {hit['metadata']} {hit['text'][:80]!r}")
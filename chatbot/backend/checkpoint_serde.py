@@ -0,0 +1,559 @@
+# checkpoint_serde.py
+"""
+更快、更小的 checkpoint 序列化器（实现 langgraph 的 SerializerProtocol，可直接传给 checkpointer 的 serde）。
+
+默认的 JsonPlusSerializer 对每条消息都写一遍模块路径、类名和全部字段名，model_name / finish_reason /
+token_usage 这类重复的元数据也逐条重复；而且每个 superstep 都把完整的消息历史从头再编码一遍。这里的编码：
+1. 消息：只写与字段默认值不同的字段，反序列化时直接构造对象（不再跑一遍校验）
+2. 形状表：相同的 (类型, 字段名, 槽位类型) 组合只写一次，字典和消息按位置写值，不重复字段名
+3. 字符串表：固定几个键下的短字符串（模型名、finish_reason、工具名等，取值范围有限）只写一次，之后用编号引用；
+   消息正文、id、工具参数、时间戳等每个会话各不相同的值一律内联，不进表
+4. 编码结果超过阈值时用 zlib 压缩（只在确实变小时）
+
+字符串/形状的编号在同一个序列化器里保持不变，所以每条消息的编码可以缓存：下一个 checkpoint 里
+没变的消息直接复用，只编码新消息。每一轮对话开始时消息都是从 checkpoint 里刚解码出来的新对象，
+所以解码时把消息和它的编码一起登记进缓存，这一轮写回时同样只编码新消息。
+每个 payload 仍然自带它用到的表项（以及表的代号，只有同一代的 payload 才会登记缓存），可以单独反序列化。
+表里因此不会有任何会话自己的内容：删除会话不需要清理表，表的大小也只取决于模型/工具的种类。
+消息类只接受 langchain_core.messages 里的具体消息类型，反序列化时按白名单查找，不会按 payload 里的路径导入模块。
+消息对象按不可变对待：字段被重新赋值会重新编码，但原地修改嵌套的 dict/list 不会被发现
+（这种用法请传 cache_messages=False）。
+遇到不支持的类型（tuple、datetime、非字符串键等）整个值交给默认序列化器，保证逐值精确还原。
+"""
+import operator
+import os
+import threading
+import weakref
+import zlib
+
+import langchain_core.messages
+import ormsgpack
+from langchain_core.messages import BaseMessage, BaseMessageChunk
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from pydantic_core import PydanticUndefined
+
+FORMAT = "fastcp"
+FORMAT_COMPRESSED = "fastcp+zlib"
+INTERN_MAX_LEN = 64
+# 只有这些键下的字符串进字符串表：取值来自模型/工具的有限集合，不含用户内容
+INTERN_KEYS = frozenset({
+    "type", "name", "status", "role", "model_name", "model_provider", "system_fingerprint",
+    "finish_reason", "service_tier",
+})
+
+STRING, RAW, CONTAINER = "s", "r", "c"
+DICT, LIST, MESSAGE = "d", "l", "m"
+
+
+class _Unsupported(Exception):
+    pass
+
+
+_message_fields = {}
+_class_cache = {}
+
+
+def _fields_of(cls) -> tuple[dict, list]:
+    """(default of every field that has one, [(name, default_factory, default)] in field order)."""
+    fields = _message_fields.get(cls)
+    if fields is None:
+        defaults = {}
+        layout = []
+        for name, field in cls.model_fields.items():
+            if field.default_factory is not None:
+                defaults[name] = field.default_factory()
+                layout.append((name, field.default_factory, None))
+            else:
+                if field.default is not PydanticUndefined:
+                    defaults[name] = field.default
+                layout.append((name, None, field.default))
+        fields = _message_fields[cls] = (defaults, layout)
+    return fields
+
+
+# 允许出现在 payload 里的消息类：langchain_core.messages 导出的具体消息类型
+MESSAGE_CLASSES = {
+    f"{cls.__module__}:{cls.__qualname__}": cls
+    for cls in (getattr(langchain_core.messages, name) for name in langchain_core.messages.__all__)
+    if isinstance(cls, type) and issubclass(cls, BaseMessage) and cls not in (BaseMessage, BaseMessageChunk)
+}
+
+
+def _message_class(path: str):
+    cls = MESSAGE_CLASSES.get(path)
+    if cls is None:
+        raise ValueError(f"not an allowed message class: {path}")
+    return cls
+
+
+_intern_positions = {}
+
+
+def _interned(keys: tuple) -> frozenset:
+    """Positions of `keys` whose short string values go through the string table."""
+    positions = _intern_positions.get(keys)
+    if positions is None:
+        positions = _intern_positions[keys] = frozenset(i for i, k in enumerate(keys) if k in INTERN_KEYS)
+    return positions
+
+
+class _PayloadTables:
+    """Table ids of one decoded payload, shared by the cache entries of its messages."""
+
+    __slots__ = ("strings", "shapes", "added_to")
+
+    def __init__(self, strings, shapes):
+        self.strings = strings
+        self.shapes = shapes
+        self.added_to = None  # 最近一次合并进的 used_strings
+
+
+class _Encoder:
+    """
+    String/shape tables with stable ids plus a per-message encoding cache.
+    Every container is encoded as `[shape id, *slots]`; `used` collects the table ids a payload needs.
+    """
+
+    def __init__(self, cache_messages: bool):
+        self.cache_messages = cache_messages
+        self.generation = os.urandom(8)  # 写进每个 payload，解码时据此判断表编号是否仍然有效
+        self.string_ids = {}
+        self.strings = []
+        self.shape_ids = {}
+        self.shapes = []
+        # id(message) -> (weakref, field values, slot, string ids, shape ids)，解码登记的是 (..., _PayloadTables, None)
+        self.messages = {}
+
+    def __len__(self):
+        return len(self.strings) + len(self.shapes)
+
+    def _shape(self, key):
+        index = self.shape_ids.get(key)
+        if index is None:
+            index = self.shape_ids[key] = len(self.shapes)
+            self.shapes.append(list(key))
+        return index
+
+    def _forget(self, key):
+        return lambda _: self.messages.pop(key, None)
+
+    def seed(self, seeds, tables: "_PayloadTables"):
+        """Cache the encodings of messages just decoded from a payload of this generation."""
+        messages = self.messages
+        for message, values, slot in seeds:
+            key = id(message)
+            messages[key] = (weakref.ref(message, self._forget(key)), values, slot, tables, None)
+
+    def encode(self, value, used_strings: set, used_shapes: set):
+        """Return the slot of a container or message."""
+        t = type(value)
+        if t is dict:
+            for k in value:
+                if type(k) is not str:
+                    raise _Unsupported("non-string dict key")
+            return self.container(DICT, "", tuple(value), value.values(), used_strings, used_shapes)
+        if t is list:
+            return self.container(LIST, "", (), value, used_strings, used_shapes)
+        if isinstance(value, BaseMessage):
+            return self.message(value, used_strings, used_shapes)
+        raise _Unsupported(t.__name__)
+
+    def message(self, value, used_strings, used_shapes):
+        if value.__pydantic_private__:
+            raise _Unsupported("message with private attributes")
+        key = id(value)
+        values = tuple(value.__dict__.values())
+        cached = self.messages.get(key)
+        # 缓存里持有旧字段值的引用，所以按 `is` 比较是可靠的（旧对象不会被回收后复用地址）
+        if (cached is not None and cached[0]() is value and len(cached[1]) == len(values)
+                and all(map(operator.is_, cached[1], values))):
+            if cached[4] is not None:
+                used_strings.update(cached[3])
+                used_shapes.update(cached[4])
+            elif cached[3].added_to is not used_strings:
+                # 解码登记的消息共用整个 payload 的表项，每次编码只合并一次
+                cached[3].added_to = used_strings
+                used_strings.update(cached[3].strings)
+                used_shapes.update(cached[3].shapes)
+            return cached[2]
+
+        cls = type(value)
+        defaults = _fields_of(cls)[0]
+        fields = {}
+        for name, v in value.__dict__.items():
+            if name in defaults:
+                d = defaults[name]
+                if type(v) is type(d) and v == d:
+                    continue
+            fields[name] = v
+        if value.__pydantic_extra__:
+            fields.update(value.__pydantic_extra__)
+        path = f"{cls.__module__}:{cls.__qualname__}"
+        if path not in MESSAGE_CLASSES:
+            raise _Unsupported(path)  # 自定义消息类交给默认序列化器
+        strings, shapes = set(), set()
+        slot = self.container(MESSAGE, path, tuple(fields), fields.values(), strings, shapes)
+        if self.cache_messages and not value.__pydantic_extra__:
+            self.messages[key] = (weakref.ref(value, self._forget(key)), values, slot, strings, shapes)
+        used_strings.update(strings)
+        used_shapes.update(shapes)
+        return slot
+
+    def container(self, tag, path, keys, values, used_strings, used_shapes):
+        # 热点循环：标量在这里直接处理，只有嵌套容器才递归
+        string_ids = self.string_ids
+        strings = self.strings
+        interned = _interned(keys) if keys else ()
+        kinds = []
+        slots = [0]
+        for i, v in enumerate(values):
+            t = type(v)
+            if t is str:
+                if i in interned and len(v) <= INTERN_MAX_LEN:
+                    index = string_ids.get(v)
+                    if index is None:
+                        index = string_ids[v] = len(strings)
+                        strings.append(v)
+                    used_strings.add(index)
+                    kinds.append(STRING)
+                    slots.append(index)
+                else:
+                    kinds.append(RAW)
+                    slots.append(v)
+            elif v is None or t is int or t is float or t is bool or t is bytes:
+                kinds.append(RAW)
+                slots.append(v)
+            else:
+                kinds.append(CONTAINER)
+                slots.append(self.encode(v, used_strings, used_shapes))
+        slots[0] = shape = self._shape((tag, path, keys, "".join(kinds)))
+        used_shapes.add(shape)
+        return slots
+
+
+_templates = {}
+
+
+def _message_template(cls, keys):
+    """
+    (field dict template in declaration order, fields filled by default_factory) for messages
+    written with `keys`; None if some key is not a declared field (an extra).
+    """
+    template = _templates.get((cls, keys))
+    if template is None:
+        layout = _fields_of(cls)[1]
+        if not set(keys) <= {name for name, _, _ in layout}:
+            template = _templates[(cls, keys)] = (None, None)
+        else:
+            fields = {name: default for name, _, default in layout}
+            factories = [(name, factory) for name, factory, _ in layout if factory is not None and name not in keys]
+            template = _templates[(cls, keys)] = (fields, factories)
+    return template
+
+
+def _construct(cls, keys, values):
+    """
+    Same result as `cls.model_construct(**dict(zip(keys, values)))` without its per-call
+    overhead: omitted fields get their defaults, unknown keys become extras.
+    """
+    template, factories = _message_template(cls, keys)
+    if template is None:
+        extra = dict(zip(keys, values))
+        fields = {}
+        for name, factory, default in _fields_of(cls)[1]:
+            fields[name] = extra.pop(name) if name in extra else factory() if factory is not None else default
+    else:
+        extra = {}
+        fields = template.copy()  # 先按声明顺序放好全部字段，update 不会改变顺序
+        for name, factory in factories:
+            fields[name] = factory()
+        fields.update(zip(keys, values))
+    message = cls.__new__(cls)
+    _setattr = object.__setattr__
+    _setattr(message, "__dict__", fields)
+    _setattr(message, "__pydantic_fields_set__", set(keys))
+    _setattr(message, "__pydantic_extra__", extra)
+    _setattr(message, "__pydantic_private__", None)
+    return message
+
+
+class _Decoder:
+    """
+    Decodes one payload; each shape is prepared once into (tag, class, keys, string slots, container slots).
+    With `seed`, every decoded message is also collected in `seeds` as (message, field values, slot).
+    """
+
+    def __init__(self, strings: dict, shapes: dict, seed: bool = False):
+        self.strings = strings
+        self.seeds = [] if seed else None
+        self.shapes = {}
+        for shape_id, (tag, path, keys, kinds) in shapes.items():
+            self.shapes[shape_id] = (
+                tag, _message_class(path) if tag == MESSAGE else None, tuple(keys),
+                [i for i, k in enumerate(kinds) if k == STRING],
+                [i for i, k in enumerate(kinds) if k == CONTAINER],
+            )
+
+    def decode(self, slot):
+        tag, cls, keys, string_slots, container_slots = self.shapes[slot[0]]
+        values = slot[1:]  # 副本：slot 本身保持编码后的样子，登记缓存时原样复用
+        strings = self.strings
+        for i in string_slots:
+            values[i] = strings[values[i]]
+        for i in container_slots:
+            values[i] = self.decode(values[i])
+        if tag == LIST:
+            return values
+        if tag == DICT:
+            return dict(zip(keys, values))
+        message = _construct(cls, keys, values)
+        if self.seeds is not None and not message.__pydantic_extra__:  # 和编码时一样，带 extra 的消息不缓存
+            self.seeds.append((message, tuple(message.__dict__.values()), slot))
+        return message
+
+
+class FastCheckpointSerializer:
+    """
+    Drop-in checkpoint serde. Lists and dicts (message histories, writes, checkpoint bodies)
+    use the compact encoding; everything else goes to the default serializer.
+    """
+
+    def __init__(self, compress_threshold: int | None = 4096, compress_level: int = 1,
+                 cache_messages: bool = True, max_table_entries: int = 1_000_000, fallback=None):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.cache_messages = cache_messages
+        self.max_table_entries = max_table_entries
+        self.fallback = fallback or JsonPlusSerializer()
+        self._lock = threading.Lock()
+        self._encoder = _Encoder(cache_messages)
+
+    def dumps_typed(self, obj) -> tuple[str, bytes]:
+        if type(obj) is not list and type(obj) is not dict:
+            return self.fallback.dumps_typed(obj)
+        used_strings, used_shapes = set(), set()
+        try:
+            with self._lock:
+                encoder = self._encoder
+                if len(encoder) > self.max_table_entries:
+                    # 表只增不减（消息 id 等唯一字符串也会进表），太大时整体重建
+                    encoder = self._encoder = _Encoder(self.cache_messages)
+                root = encoder.encode(obj, used_strings, used_shapes)
+                strings = [encoder.strings[i] for i in used_strings]
+                shapes = [encoder.shapes[i] for i in used_shapes]
+                generation = encoder.generation
+            data = ormsgpack.packb([list(used_strings), strings, list(used_shapes), shapes, root, generation])
+        except (_Unsupported, TypeError, ormsgpack.MsgpackEncodeError):
+            return self.fallback.dumps_typed(obj)
+        if self.compress_threshold is not None and len(data) > self.compress_threshold:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < len(data):
+                return FORMAT_COMPRESSED, compressed
+        return FORMAT, data
+
+    def loads_typed(self, data: tuple[str, bytes]):
+        type_, payload = data
+        if type_ == FORMAT_COMPRESSED:
+            payload = zlib.decompress(payload)
+        elif type_ != FORMAT:
+            return self.fallback.loads_typed(data)
+        string_ids, strings, shape_ids, shapes, root, generation = ormsgpack.unpackb(payload)
+        seed = self.cache_messages and generation == self._encoder.generation
+        decoder = _Decoder(dict(zip(string_ids, strings)), dict(zip(shape_ids, shapes)), seed)
+        value = decoder.decode(root)
+        if decoder.seeds:
+            tables = _PayloadTables(string_ids, shape_ids)
+            with self._lock:
+                if self._encoder.generation == generation:
+                    self._encoder.seed(decoder.seeds, tables)
+        return value
+
+
+if __name__ == "__main__":
+    # 对比默认序列化器：10~1000 条消息的会话历史，每个 checkpoint 的字节数和序列化/反序列化耗时
+    import gc
+    import json
+    import random
+    import statistics
+    import time
+
+    from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+    def make_history(n, rng):
+        history = []
+        i = 0
+        while len(history) < n:
+            history.append(HumanMessage(content=f"问题 {i}: " + "请介绍一下上海明天的天气和出行建议。" * rng.randint(1, 3),
+                                        id=f"run-{i}-human"))
+            if i % 3 == 0:
+                call_id = f"call_{i:08x}"
+                history.append(AIMessage(
+                    content="", id=f"run-{i}-tool",
+                    tool_calls=[{"name": "tavily_search", "args": {"query": f"上海 天气 {i}"}, "id": call_id, "type": "tool_call"}],
+                    response_metadata={"token_usage": {"completion_tokens": 20, "prompt_tokens": 800 + i,
+                                                       "total_tokens": 820 + i, "prompt_cache_hit_tokens": 768},
+                                       "model_name": "deepseek-chat", "system_fingerprint": "fp_ffc7281d48",
+                                       "finish_reason": "tool_calls", "logprobs": None},
+                    usage_metadata={"input_tokens": 800 + i, "output_tokens": 20, "total_tokens": 820 + i,
+                                    "input_token_details": {"cache_read": 768}},
+                ))
+                history.append(ToolMessage(
+                    content="## 上海天气预报 (https://weather.example.com/shanghai)\n- " + "上海明天多云转小雨，气温18到24度。" * 8,
+                    tool_call_id=call_id, name="tavily_search", id=f"run-{i}-result",
+                ))
+            history.append(AIMessage(
+                content="明天上海多云转小雨，" * rng.randint(3, 12), id=f"run-{i}-answer",
+                response_metadata={"token_usage": {"completion_tokens": 60, "prompt_tokens": 900 + i,
+                                                   "total_tokens": 960 + i, "prompt_cache_hit_tokens": 896},
+                                   "model_name": "deepseek-chat", "system_fingerprint": "fp_ffc7281d48",
+                                   "finish_reason": "stop", "logprobs": None},
+                usage_metadata={"input_tokens": 900 + i, "output_tokens": 60, "total_tokens": 960 + i,
+                                "input_token_details": {"cache_read": 896}},
+            ))
+            i += 1
+        return history[:n]
+
+    def same(loaded, value):
+        """Equal values, types and field order (so model_dump / JSON output is identical too)."""
+        return loaded == value and [type(m) for m in loaded] == [type(m) for m in value] and all(
+            json.dumps(a.model_dump(), ensure_ascii=False) == json.dumps(b.model_dump(), ensure_ascii=False)
+            for a, b in zip(loaded, value)
+        )
+
+    def bench(serde, history):
+        """
+        Per-checkpoint cost on a history of len(history) messages:
+        - cold: the whole history encoded from scratch (e.g. first checkpoint after a restart)
+        - turn: what a checkpointer does every turn — the history is loaded from the previous
+          checkpoint, one new message is appended in a new list (operator.add) and written back
+        - load: decoding the checkpoint
+        """
+        repeat = max(3, 1000 // len(history))
+        steps = min(20, len(history) // 2)
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            cold = serde.dumps_typed(list(history))
+            if hasattr(serde, "_encoder"):
+                serde._encoder = _Encoder(serde.cache_messages)  # 冷启动：清空表和缓存
+        cold_us = (time.perf_counter() - start) / repeat * 1e6
+
+        dumped = serde.dumps_typed(history[:-steps])
+        turn_s = 0.0
+        for i in range(len(history) - steps, len(history)):
+            state = serde.loads_typed(dumped)  # 每一轮都从 checkpoint 重新加载
+            start = time.perf_counter()
+            dumped = serde.dumps_typed(state + [history[i]])
+            turn_s += time.perf_counter() - start
+        turn_us = turn_s / steps * 1e6
+
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            loaded = serde.loads_typed(dumped)
+        load_us = (time.perf_counter() - start) / repeat * 1e6
+        assert same(loaded, history), "round trip must be exact"
+        assert same(serde.loads_typed(cold), history), "round trip must be exact"
+        return len(dumped[1]), cold_us, turn_us, load_us
+
+    class TimedSerde:
+        """Wraps a serde and adds up the time spent in it."""
+
+        def __init__(self, serde):
+            self.serde = serde
+            self.dump_s = self.load_s = 0.0
+
+        def dumps_typed(self, obj):
+            start = time.perf_counter()
+            try:
+                return self.serde.dumps_typed(obj)
+            finally:
+                self.dump_s += time.perf_counter() - start
+
+        def loads_typed(self, data):
+            start = time.perf_counter()
+            try:
+                return self.serde.loads_typed(data)
+            finally:
+                self.load_s += time.perf_counter() - start
+
+    def bench_graph(serde, history, turns=40):
+        """
+        Serializer time per turn of a real graph on an InMemorySaver: every invoke loads the
+        thread's checkpoint, then writes the user message and the reply back. Medians over the
+        turns, so an occasional full GC pause landing in one turn does not decide the result.
+        """
+        from langgraph.graph import START, MessagesState, StateGraph
+
+        def reply(state):
+            return {"messages": [AIMessage(content="好的，" * 20, id=f"reply-{len(state['messages'])}")]}
+
+        timed = TimedSerde(serde)
+        graph = (StateGraph(MessagesState).add_node("reply", reply).add_edge(START, "reply")
+                 .compile(checkpointer=InMemorySaver(serde=timed)))
+        config = {"configurable": {"thread_id": "bench"}}
+        graph.invoke({"messages": history}, config)
+        gc.collect()
+        dumps, loads = [], []
+        for i in range(turns):
+            timed.dump_s = timed.load_s = 0.0
+            graph.invoke({"messages": [HumanMessage(content=f"追问 {i}", id=f"followup-{i}")]}, config)
+            dumps.append(timed.dump_s * 1e3)
+            loads.append(timed.load_s * 1e3)
+        messages = graph.get_state(config).values["messages"]
+        assert len(messages) == len(history) + 1 + 2 * turns
+        return statistics.median(dumps), statistics.median(loads)
+
+    from langgraph.checkpoint.memory import InMemorySaver
+
+    rng = random.Random(0)
+    serdes = {
+        "default": lambda: JsonPlusSerializer(),
+        "fast": lambda: FastCheckpointSerializer(compress_threshold=None),
+        "fast+zlib": lambda: FastCheckpointSerializer(),
+    }
+    # 精确还原：其他类型和不支持的值交给默认序列化器
+    fast = serdes["fast+zlib"]()
+    for value in [3, "x", None, {"a": {1, 2}}, {1: "a"}, [SystemMessage(content="s", name="n", id="1")],
+                  {"v": 1, "ts": "2025-01-01T00:00:00+00:00", "channel_versions": {"messages": "00000002.0.1"}},
+                  [AIMessage(content=[{"type": "text", "text": "hi"}], additional_kwargs={"x": [1, 2.5, True]})],
+                  [HumanMessage(content="extra field", custom="kept")]]:
+        assert fast.loads_typed(fast.dumps_typed(value)) == value, value
+    # 字段被重新赋值后不能用到旧的缓存
+    message = AIMessage(content="before")
+    fast.dumps_typed([message])
+    message.content = "after"
+    assert fast.loads_typed(fast.dumps_typed([message]))[0].content == "after"
+    # 解码出来的消息登记进缓存，写回时不再重新编码；被修改过的照样重新编码
+    history = make_history(30, rng)
+    loaded = fast.loads_typed(fast.dumps_typed(history))
+    assert all(id(m) in fast._encoder.messages for m in loaded)
+    loaded[0].content = "changed"
+    again = fast.loads_typed(fast.dumps_typed(loaded + [HumanMessage(content="new", id="new")]))
+    assert same(again, loaded + [HumanMessage(content="new", id="new")])
+    # 其他序列化器（或重建表之前）写的 payload 照常解码，但不登记缓存
+    other = serdes["fast+zlib"]()
+    assert same(other.loads_typed(fast.dumps_typed(history)), history) and not other._encoder.messages
+    # 会话自己的内容（正文、id、工具参数）不进共享的字符串表
+    fast.dumps_typed([HumanMessage(content="只属于这个会话的话", id="thread-message"),
+                      AIMessage(content="", tool_calls=[{"name": "tavily_search", "args": {"query": "私人问题"},
+                                                         "id": "call_1", "type": "tool_call"}])])
+    assert not {"只属于这个会话的话", "thread-message", "私人问题", "call_1"} & set(fast._encoder.string_ids)
+    assert "tavily_search" in fast._encoder.string_ids
+    # 只接受白名单里的消息类，不按 payload 里的路径导入模块
+    forged = ormsgpack.packb([[], [], [0], [[MESSAGE, "os:system", [], ""]], [0], b""])
+    try:
+        fast.loads_typed((FORMAT, forged))
+        raise AssertionError("forged message class must be rejected")
+    except ValueError:
+        pass
+
+    print(f"{'messages':>8} {'serializer':>10} {'bytes':>9} {'cold dump µs':>13} {'turn dump µs':>13} {'load µs':>9}"
+          f" {'graph dump ms/turn':>19} {'graph load ms/turn':>19}")
+    for n in (10, 100, 1000):
+        history = make_history(n, rng)
+        for name, make_serde in serdes.items():
+            size, cold_us, turn_us, load_us = bench(make_serde(), history)
+            graph_dump_ms, graph_load_ms = bench_graph(make_serde(), history)
+            print(f"{n:>8} {name:>10} {size:>9} {cold_us:>13.0f} {turn_us:>13.0f} {load_us:>9.0f}"
+                  f" {graph_dump_ms:>19.2f} {graph_load_ms:>19.2f}")
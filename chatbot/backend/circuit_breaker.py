@@ -0,0 +1,186 @@
+# circuit_breaker.py
+"""
+工具调用的超时 + 熔断。
+
+- 每个工具有自己的截止时间（deadline），超时立即返回错误信息给模型，不再等客户端自己的超时。
+- 熔断器：连续失败达到阈值 -> open（直接拒绝，不再打到下游）；冷却时间过后 -> half-open，
+  只放行少量探测请求，成功则 closed，失败则重新 open。
+- 熔断状态可作为指标导出（0=closed, 1=half_open, 2=open）。
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from langchain_core.tools import BaseTool, StructuredTool
+
+from sse_stream import emit_event
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with half-open probing."""
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30.0, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self.opens = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def allow(self) -> bool:
+        """Whether a call may go through now (counts half-open probes)."""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                print(f"[breaker] {self.name}: closed")
+            self._state = CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            state = self._current_state()
+            if state == HALF_OPEN or (state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self.opens += 1
+                print(f"[breaker] {self.name}: open after {self._failures} consecutive failures")
+
+    def report(self) -> dict:
+        with self._lock:
+            state = self._current_state()
+            return {
+                "state": state,
+                "state_gauge": STATE_GAUGE[state],
+                "consecutive_failures": self._failures,
+                "opens": self.opens,
+                "rejected": self.rejected,
+            }
+
+
+class BreakerRegistry:
+    def __init__(self):
+        self.breakers = {}
+
+    def get(self, name, **kwargs) -> CircuitBreaker:
+        return self.breakers.setdefault(name, CircuitBreaker(name, **kwargs))
+
+    def report(self) -> dict:
+        return {name: breaker.report() for name, breaker in self.breakers.items()}
+
+
+circuit_breakers = BreakerRegistry()
+
+
+def notify_degraded(tool_name: str, reason: str):
+    """Emit a `degraded_mode` stream event (turned into an SSE flag by sse_stream.py)."""
+    emit_event("degraded_mode", {"tool": tool_name, "reason": reason})
+
+
+def guard_tool(tool: BaseTool, deadline: float, breaker: CircuitBreaker | None = None, max_workers: int = 4) -> BaseTool:
+    """
+    Wrap `tool` with a per-call deadline and an optional circuit breaker.
+    Name, description and argument schema are unchanged, so the model sees the same tool.
+    Failures are returned as text so the model can answer without the tool.
+    """
+    # 每个工具一个线程池，调用方只等到截止时间为止；超时的调用在后台自然结束，
+    # 只占用本工具的线程，不会让其他工具排队错过截止时间
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"tool-{tool.name}")
+
+    def guarded(**kwargs):
+        if breaker is not None and not breaker.allow():
+            notify_degraded(tool.name, "circuit_open")
+            return f"{tool.name} 暂时不可用（熔断中），请不要再调用该工具，直接基于已有信息回答。"
+        future = executor.submit(tool.invoke, kwargs)
+        try:
+            result = future.result(timeout=deadline)
+        except FutureTimeoutError:
+            reason = f"超过 {deadline:g}s 未返回"
+        except Exception as e:
+            reason = f"调用失败: {e}"
+        else:
+            if isinstance(result, dict) and "error" in result:
+                # TavilySearch 把非 ToolException 的异常（连接失败、5xx 等）作为 {"error": e} 返回
+                reason = f"调用失败: {result['error']}"
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+        print(f"[tool] {tool.name}: {reason}")
+        if breaker is not None:
+            breaker.record_failure()
+        notify_degraded(tool.name, reason)
+        return f"{tool.name} {reason}，请直接基于已有信息回答。"
+
+    return StructuredTool.from_function(
+        func=guarded, name=tool.name, description=tool.description, args_schema=tool.args_schema,
+    )
+
+
+if __name__ == "__main__":
+    # 检查：以返回值报告的错误也计为失败；一个工具的慢调用不占用其他工具的线程
+    from langchain_core.tools import tool as make_tool
+
+    @make_tool
+    def flaky_search(query: str) -> dict:
+        """Search that reports failures in its result, like TavilySearch."""
+        return {"error": ConnectionError("connection refused")}
+
+    breaker = CircuitBreaker("flaky_search", failure_threshold=3, reset_timeout=60)
+    guarded_search = guard_tool(flaky_search, deadline=1.0, breaker=breaker)
+    outputs = [guarded_search.invoke({"query": "x"}) for _ in range(5)]
+    print(breaker.report())
+    assert breaker.state == OPEN and breaker.report()["rejected"] == 2, breaker.report()
+    assert "connection refused" in outputs[0] and "熔断中" in outputs[-1]
+
+    @make_tool
+    def stuck_search(query: str) -> str:
+        """Search whose upstream hangs."""
+        time.sleep(1.0)
+        return "late"
+
+    @make_tool
+    def local_search(query: str) -> str:
+        """Fast local search."""
+        return "local hit"
+
+    slow = guard_tool(stuck_search, deadline=0.05, max_workers=2)
+    fast = guard_tool(local_search, deadline=0.5)
+    for _ in range(4):
+        assert "未返回" in slow.invoke({"query": "x"})  # 两个线程都被挂住的调用占满
+    start = time.monotonic()
+    assert fast.invoke({"query": "x"}) == "local hit"
+    print(f"local tool answered in {(time.monotonic() - start) * 1000:.1f} ms while the web tool pool is saturated")
+    assert time.monotonic() - start < 0.5
+    print("circuit breaker check passed")
@@ -0,0 +1,451 @@
+# dispatcher.py
+## pip install fastapi uvicorn httpx
+"""
+多进程服务模式：前端分发进程 + N 个 worker 进程（每个都运行 main:app 和编译好的 agent）。
+
+- 每个 worker 有自己的 InMemorySaver，所以同一个 thread_id 必须始终落到同一个 worker：
+  新 thread 用一致性哈希（带虚拟节点）选择 worker，分配结果记在分发进程里（sticky），之后一直按记录转发。
+- worker 通过 unix socket 监听，分发进程用 httpx 流式转发 SSE，逐块透传，不做缓冲。
+- worker 异常退出后在原槽位重启（哈希环不变，其他 worker 上的会话不受影响）。
+- 扩容只影响新 thread 的分配，已有 thread 留在原 worker；缩容前先停止分配新请求并等待在途请求结束（drain），
+  被删除的 worker 上的 thread 随之结束（InMemorySaver 不跨进程，不做迁移）。
+
+启动：python dispatcher.py --workers 4 --port 8000
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import httpx
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from admin_auth import ADMIN_HEADER, ADMIN_TOKEN, require_admin
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER_READY_TIMEOUT = 60  # 秒：worker 启动（导入 agent）的最长等待时间
+# 与 worker 的会话过期时间一致：分配记录空闲超过该时间时 worker 上的会话也已被清理
+THREAD_IDLE_TTL = float(os.environ.get("THREAD_IDLE_TTL", str(2 * 3600)))
+DRAIN_TIMEOUT = 120  # 秒：删除 worker 时等待在途流结束的最长时间
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",  # 禁用 Nginx 缓冲
+}
+
+
+##---------------------------------------------------
+## (1) Consistent hash ring
+##---------------------------------------------------
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes."""
+
+    def __init__(self, vnodes=160):
+        self.vnodes = vnodes
+        self._keys = []
+        self._nodes = []
+
+    def add(self, node_id: int):
+        for i in range(self.vnodes):
+            key = _hash(f"worker-{node_id}#{i}")
+            pos = bisect.bisect(self._keys, key)
+            self._keys.insert(pos, key)
+            self._nodes.insert(pos, node_id)
+
+    def remove(self, node_id: int):
+        keep = [(k, n) for k, n in zip(self._keys, self._nodes) if n != node_id]
+        self._keys = [k for k, _ in keep]
+        self._nodes = [n for _, n in keep]
+
+    def get(self, key: str) -> int:
+        if not self._keys:
+            raise LookupError("hash ring is empty")
+        pos = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[pos]
+
+
+##---------------------------------------------------
+## (2) Worker processes
+##---------------------------------------------------
+class Worker:
+    """One `uvicorn main:app` process listening on a unix socket."""
+
+    def __init__(self, worker_id: int, socket_dir: str):
+        self.id = worker_id
+        self.uds = os.path.join(socket_dir, f"worker-{worker_id}.sock")
+        self.proc = None
+        self.client = None
+        self.ready = asyncio.Event()
+        self.in_flight = 0
+        self.draining = False
+        self.restarts = 0
+
+    async def start(self):
+        self.ready.clear()
+        if os.path.exists(self.uds):
+            os.remove(self.uds)
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "uvicorn", "main:app", "--uds", self.uds, "--log-level", "warning",
+            cwd=BACKEND_DIR,
+        )
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(uds=self.uds), base_url="http://worker", timeout=None
+            )
+        await self._wait_ready()
+
+    async def _wait_ready(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WORKER_READY_TIMEOUT
+        while loop.time() < deadline:
+            if self.proc.returncode is not None:
+                raise RuntimeError(f"worker {self.id} exited during start-up with code {self.proc.returncode}")
+            try:
+                resp = await self.client.get("/", timeout=1.0)
+                if resp.status_code == 200:
+                    self.ready.set()
+                    print(f"[dispatcher] worker {self.id} ready (pid {self.proc.pid})")
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"worker {self.id} not ready after {WORKER_READY_TIMEOUT}s")
+
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def stop(self, drain=True):
+        """Stop taking requests, wait for in-flight streams (if `drain`), then terminate."""
+        self.draining = True
+        self.ready.clear()
+        if drain:
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + DRAIN_TIMEOUT
+            while self.in_flight and loop.time() < deadline:
+                await asyncio.sleep(0.1)
+        if self.alive():
+            self.proc.terminate()
+            try:
+                await asyncio.wait_for(self.proc.wait(), timeout=10)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+                await self.proc.wait()
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def info(self):
+        return {
+            "id": self.id,
+            "pid": self.proc.pid if self.proc else None,
+            "alive": self.alive(),
+            "ready": self.ready.is_set(),
+            "draining": self.draining,
+            "in_flight": self.in_flight,
+            "restarts": self.restarts,
+        }
+
+
+class WorkerPool:
+    """Owns the workers, the hash ring, the thread -> worker assignments and the supervisor task."""
+
+    def __init__(self, n_workers: int, idle_ttl: float = THREAD_IDLE_TTL):
+        self.n_workers = n_workers
+        self.idle_ttl = idle_ttl
+        self.socket_dir = tempfile.mkdtemp(prefix="chat-workers-")
+        self.workers = {}
+        self.ring = HashRing()
+        # thread_id -> (worker id, 最后一次转发的时间)，按最近使用排序；哈希环只决定新 thread 的去处
+        self.assignments = OrderedDict()
+        self._next_id = 0
+        self._supervisor = None
+
+    async def start(self):
+        await asyncio.gather(*(self.add_worker() for _ in range(self.n_workers)))
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def add_worker(self) -> Worker:
+        worker = Worker(self._next_id, self.socket_dir)
+        self._next_id += 1
+        await worker.start()
+        # 启动完成后才加入哈希环，新 thread 不会分到未就绪的进程
+        self.workers[worker.id] = worker
+        self.ring.add(worker.id)
+        return worker
+
+    async def remove_worker(self, worker_id: int):
+        worker = self.workers.get(worker_id)
+        if worker is None:
+            raise KeyError(worker_id)
+        if len(self.workers) == 1:
+            raise ValueError("cannot remove the last worker")
+        # 先从哈希环摘除（新 thread 分到其他 worker），再等在途请求结束
+        self.ring.remove(worker_id)
+        await worker.stop(drain=True)
+        del self.workers[worker_id]
+        lost = [tid for tid, (wid, _) in self.assignments.items() if wid == worker_id]
+        for thread_id in lost:
+            del self.assignments[thread_id]
+        print(f"[dispatcher] removed worker {worker_id}, {len(lost)} threads ended with it")
+
+    def assign(self, thread_id: str) -> Worker:
+        """Place a new thread on the worker the current ring picks and remember the choice."""
+        worker_id = self.ring.get(thread_id)
+        self.assignments[thread_id] = (worker_id, time.monotonic())
+        return self.workers[worker_id]
+
+    def route(self, thread_id: str) -> Worker | None:
+        """Worker that owns an existing thread, or None if the dispatcher never assigned it."""
+        entry = self.assignments.get(thread_id)
+        if entry is None or entry[0] not in self.workers or self.workers[entry[0]].draining:
+            return None  # 正在缩容的 worker 上的 thread 不再接新请求
+        self.assignments[thread_id] = (entry[0], time.monotonic())
+        self.assignments.move_to_end(thread_id)
+        return self.workers[entry[0]]
+
+    def forget(self, thread_id: str):
+        self.assignments.pop(thread_id, None)
+
+    def expire_idle(self):
+        """Drop assignments idle longer than the workers' thread TTL (the worker has expired them too)."""
+        cutoff = time.monotonic() - self.idle_ttl
+        while self.assignments:
+            thread_id, (_, last_used) = next(iter(self.assignments.items()))
+            if last_used >= cutoff:
+                break
+            del self.assignments[thread_id]
+
+    async def _supervise(self):
+        """Restart crashed workers in place so the ring (and other threads) stay untouched."""
+        while True:
+            await asyncio.sleep(1.0)
+            self.expire_idle()
+            for worker in list(self.workers.values()):
+                if worker.draining or worker.alive():
+                    continue
+                print(f"[dispatcher] worker {worker.id} exited with code {worker.proc.returncode}, restarting")
+                worker.restarts += 1
+                try:
+                    await worker.start()
+                except Exception as e:
+                    print(f"[dispatcher] failed to restart worker {worker.id}: {e}")
+
+    async def stop(self):
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        await asyncio.gather(*(w.stop(drain=False) for w in self.workers.values()))
+
+
+##---------------------------------------------------
+## (3) Front dispatcher app
+##---------------------------------------------------
+pool = WorkerPool(int(os.environ.get("CHAT_WORKERS", os.cpu_count() or 1)))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await pool.start()
+    yield
+    await pool.stop()
+
+
+app = FastAPI(title="LangGraph Chat Agent Dispatcher", version="1.0", lifespan=lifespan)
+
+
+async def wait_ready(worker: Worker):
+    try:
+        await asyncio.wait_for(worker.ready.wait(), timeout=WORKER_READY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail=f"worker {worker.id} is not available")
+
+
+def route_existing(thread_id: str) -> Worker:
+    worker = pool.route(thread_id)
+    if worker is None:
+        raise HTTPException(status_code=404, detail="Thread not found or expired")
+    return worker
+
+
+async def forward(worker: Worker, request: Request, path: str, body: bytes, prefix: bytes = b""):
+    """Forward a request to `worker` and relay the response body chunk by chunk (after `prefix`)."""
+    await wait_ready(worker)
+
+    worker.in_flight += 1
+    try:
+        upstream = await worker.client.send(
+            worker.client.build_request(
+                request.method, path, params=request.query_params, content=body,
+                headers={"content-type": request.headers.get("content-type", "application/json")},
+            ),
+            stream=True,
+        )
+    except Exception:
+        worker.in_flight -= 1
+        raise HTTPException(status_code=502, detail=f"worker {worker.id} did not respond")
+
+    async def relay():
+        try:
+            if prefix and upstream.status_code == 200:
+                yield prefix
+            async for chunk in upstream.aiter_raw():
+                yield chunk
+        finally:
+            await upstream.aclose()
+            worker.in_flight -= 1
+
+    headers = SSE_HEADERS if upstream.headers.get("content-type", "").startswith("text/event-stream") else {}
+    return StreamingResponse(
+        relay(), status_code=upstream.status_code,
+        media_type=upstream.headers.get("content-type"), headers=headers,
+    )
+
+
+@app.post("/api/chat")
+async def chat_endpoint(request: Request):
+    """
+    按 thread_id 一致性哈希选择 worker，并原样流式转发 SSE
+    """
+    body = await request.body()
+    try:
+        payload = json.loads(body)
+        thread_id = payload.get("thread_id")
+    except (ValueError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if thread_id is not None:
+        thread_id = str(thread_id)
+        response = await forward(route_existing(thread_id), request, "/api/chat", body)
+        if response.status_code == 404:
+            pool.forget(thread_id)  # worker 上已过期
+        return response
+
+    # 新会话：分发器先分配ID并在目标 worker 上创建，再把 thread 事件放在 SSE 最前面
+    thread_id = uuid.uuid4().hex
+    worker = pool.assign(thread_id)
+    await wait_ready(worker)
+    resp = await worker.client.post("/api/threads", json={"thread_id": thread_id})
+    if resp.status_code != 201:
+        pool.forget(thread_id)
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    payload["thread_id"] = thread_id
+    event = json.dumps({"type": "thread", "content": thread_id}, ensure_ascii=False)
+    return await forward(worker, request, "/api/chat", json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                         prefix=f"data: {event}\n\n".encode("utf-8"))
+
+
+@app.post("/api/threads", status_code=201)
+async def create_thread(request: Request):
+    """
+    分配 thread_id 并在它所属的 worker 上创建会话
+    """
+    thread_id = uuid.uuid4().hex
+    response = await forward(pool.assign(thread_id), request, "/api/threads",
+                             json.dumps({"thread_id": thread_id}).encode("utf-8"))
+    if response.status_code != 201:
+        pool.forget(thread_id)
+    return response
+
+
+@app.get("/api/threads", dependencies=[Depends(require_admin)])
+async def list_threads(offset: int = Query(0, ge=0, le=900), limit: int = Query(20, ge=1, le=100)):
+    """
+    汇总各个 worker 的会话列表，按最近活跃时间合并后分页（每个 worker 取前 offset + limit 条）
+    """
+    total, items = 0, []
+    for worker in list(pool.workers.values()):
+        if worker.ready.is_set():
+            resp = await worker.client.get("/api/threads", params={"offset": 0, "limit": offset + limit},
+                                           headers={ADMIN_HEADER: ADMIN_TOKEN})
+            page = resp.json()
+            total += page["total"]
+            items.extend(page["items"])
+    items.sort(key=lambda t: t["last_active"], reverse=True)
+    return {"total": total, "offset": offset, "limit": limit, "items": items[offset:offset + limit]}
+
+
+@app.api_route("/api/threads/{thread_id}/messages", methods=["GET"])
+@app.api_route("/api/threads/{thread_id}/tool-results/{tool_call_id}", methods=["GET"])
+@app.api_route("/api/threads/{thread_id}", methods=["DELETE"])
+async def thread_endpoint(thread_id: str, request: Request):
+    """
+    单个会话的请求按 thread_id 转发到所属 worker
+    """
+    response = await forward(route_existing(thread_id), request, request.url.path, b"")
+    # 删除成功，或读取历史时 worker 报告已过期（tool-results 的 404 只表示该结果不存在）
+    if (request.method == "DELETE" and response.status_code in (200, 404)) or \
+            (response.status_code == 404 and request.url.path.endswith("/messages")):
+        pool.forget(thread_id)
+    return response
+
+
+@app.get("/admin/workers", dependencies=[Depends(require_admin)])
+def list_workers():
+    return [w.info() for w in pool.workers.values()]
+
+
+@app.post("/admin/workers", dependencies=[Depends(require_admin)])
+async def add_worker():
+    """
+    扩容一个 worker；只有新 thread 会分到它，已有 thread 留在原 worker
+    """
+    worker = await pool.add_worker()
+    return worker.info()
+
+
+@app.delete("/admin/workers/{worker_id}", dependencies=[Depends(require_admin)])
+async def remove_worker(worker_id: int):
+    """
+    缩容：先从哈希环摘除，等待在途请求结束后再停止进程
+    """
+    try:
+        await pool.remove_worker(worker_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"worker {worker_id} not found")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return JSONResponse({"removed": worker_id})
+
+
+@app.get("/api/stats/{name}")
+async def stats_endpoint(name: str):
+    """
+    汇总各个 worker 的统计（prompt-cache、model-tiers 等）
+    """
+    reports = {}
+    for worker in list(pool.workers.values()):
+        if worker.ready.is_set():
+            resp = await worker.client.get(f"/api/stats/{name}")
+            if resp.status_code == 404:
+                raise HTTPException(status_code=404, detail=f"unknown stats: {name}")
+            reports[f"worker-{worker.id}"] = resp.json()
+    return reports
+
+
+@app.get("/")
+def root():
+    return {"message": f"LangGraph Chat Agent dispatcher with {len(pool.workers)} workers. POST to /api/chat"}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Multi-process chat server with thread-affinity routing")
+    parser.add_argument("--workers", type=int, default=pool.n_workers)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    opts = parser.parse_args()
+    pool.n_workers = opts.workers
+    uvicorn.run(app, host=opts.host, port=opts.port)
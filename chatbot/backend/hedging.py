@@ -0,0 +1,300 @@
+# hedging.py
+"""
+对冲请求（hedged requests），用来削减上游模型的长尾延迟。
+
+- 先发主请求；如果在自适应阈值内（滚动 TTFT 的 p95）还没有收到第一个 token，再发一个相同的备份请求。
+- 哪个请求先吐出第一个 token 就用哪个继续流式输出，另一个被取消：每个请求是专用事件循环里的一个
+  `astream` 任务，取消任务会在它正在等待的 HTTP 读取处抛出 CancelledError，连接立即关闭，客户端也不会再重试。
+- 对冲比例有上限（默认 10%），额外成本有界；样本不足时用固定的初始阈值。
+- 和限流调度器一起用时，调度器包在外层：TTFT 从拿到配额、真正发出请求时算起，排队时间不会触发对冲。
+  备份请求经 `admit(messages)` 另外申请配额（见 `llm_scheduler.extra_call_admission`），申请不到（正在限流）就不对冲；
+  申请到的配额在备份请求结束或被取消时通过 admit 返回的回调退还。
+
+HedgedChatModel 本身是一个 BaseChatModel，包装任意能 `.astream()` 出 AIMessageChunk 的 runnable
+（例如 `llm.bind_tools(tools)`），回调/astream_events 的 token 流不受影响。
+"""
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Iterator
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+
+class HedgePolicy:
+    """Rolling TTFT percentile threshold plus a cap on the fraction of hedged calls."""
+
+    def __init__(self, percentile=0.95, window=200, min_samples=20, initial_delay=3.0,
+                 min_delay=0.2, max_hedge_rate=0.1):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_hedge_rate = max_hedge_rate
+        self._lock = threading.Lock()
+        self._ttfts = deque(maxlen=window)
+        self._hedged = deque(maxlen=window)
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self) -> float:
+        """Seconds to wait for the first token before sending the hedge."""
+        with self._lock:
+            if len(self._ttfts) < self.min_samples:
+                return self.initial_delay
+            ttfts = sorted(self._ttfts)
+        return max(self.min_delay, ttfts[min(len(ttfts) - 1, int(self.percentile * len(ttfts)))])
+
+    def allow_hedge(self) -> bool:
+        with self._lock:
+            return sum(self._hedged) < self.max_hedge_rate * max(len(self._hedged), 1)
+
+    def record(self, ttft: float, hedged: bool, hedge_won: bool):
+        with self._lock:
+            self._ttfts.append(ttft)
+            self._hedged.append(hedged)
+            self.calls += 1
+            self.hedges += hedged
+            self.hedge_wins += hedge_won
+
+    def report(self) -> dict:
+        delay = self.delay()
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": round(self.hedges / self.calls, 4) if self.calls else 0.0,
+                "current_delay_s": round(delay, 3),
+            }
+
+
+class _AttemptLoop:
+    """Background event loop running the upstream attempts, so a losing one can be cancelled mid-request."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def submit(self, coro):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="hedge-attempts", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+
+# 所有对冲请求共用一个事件循环：上游的异步 HTTP 客户端始终在同一个循环里使用
+_attempt_loop = _AttemptLoop()
+
+
+class HedgedChatModel(BaseChatModel):
+    """Chat model wrapper that hedges slow first tokens with a duplicate request."""
+
+    inner: Any  # 任意可 .astream(messages) 的 runnable
+    policy: Any = None
+    admit: Any = None  # 可选：admit(messages) -> 释放回调或 None（不放行），发备份请求前申请配额
+
+    def model_post_init(self, __context):
+        if self.policy is None:
+            self.policy = HedgePolicy()
+
+    @property
+    def _llm_type(self) -> str:
+        return "hedged-chat-model"
+
+    async def _attempt(self, attempt, messages, kwargs, events):
+        try:
+            async for chunk in self.inner.astream(messages, **kwargs):
+                events.put((attempt, "chunk", chunk))
+        except asyncio.CancelledError:
+            raise  # 输掉的请求：异步生成器随之关闭，底层 HTTP 请求被中止
+        except Exception as e:
+            events.put((attempt, "error", e))
+        else:
+            events.put((attempt, "done", None))
+
+    def _start_attempt(self, attempt, messages, kwargs, events):
+        return _attempt_loop.submit(self._attempt(attempt, messages, kwargs, events))
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        if stop is not None:
+            kwargs["stop"] = stop
+        events = queue.Queue()
+        starts = {0: time.monotonic()}
+        attempts = {0: self._start_attempt(0, messages, kwargs, events)}
+        try:
+            running = {0}
+            hedged = False
+            deadline = starts[0] + self.policy.delay()
+
+            # 等待第一个 token：超过阈值且未超出对冲比例上限时发出备份请求
+            winner, first = None, None
+            while winner is None:
+                timeout = None if hedged else max(0.0, deadline - time.monotonic())
+                try:
+                    attempt, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    release = None
+                    if self.policy.allow_hedge():
+                        release = (lambda: None) if self.admit is None else self.admit(messages)
+                    if release is not None:
+                        starts[1] = time.monotonic()
+                        attempts[1] = self._start_attempt(1, messages, kwargs, events)
+                        attempts[1].add_done_callback(lambda _, release=release: release())  # 完成、失败或被取消都会调用
+                        running.add(1)
+                    hedged = True
+                    continue
+                if kind == "error":
+                    running.discard(attempt)
+                    if not running:
+                        raise payload
+                    continue
+                winner, first = attempt, (kind, payload)
+
+            for attempt in running - {winner}:
+                attempts[attempt].cancel()
+            # 记录胜出请求自身的 TTFT（从它发出时算起）
+            self.policy.record(time.monotonic() - starts[winner], hedged=1 in starts, hedge_won=winner == 1)
+
+            kind, payload = first
+            while True:
+                if kind == "done":
+                    return
+                if kind == "error":
+                    raise payload
+                yield ChatGenerationChunk(message=payload)
+                attempt, kind, payload = events.get()
+                while attempt != winner:
+                    attempt, kind, payload = events.get()
+        finally:
+            # 调用方提前停止消费或出错时，同样中止仍在进行的请求
+            for future in attempts.values():
+                future.cancel()
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+
+class HedgeStats:
+    """Registry of named hedge policies for reporting."""
+
+    def __init__(self):
+        self.policies = {}
+
+    def wrap(self, name: str, model, admit=None, **policy_kwargs) -> HedgedChatModel:
+        policy = self.policies.setdefault(name, HedgePolicy(**policy_kwargs))
+        return HedgedChatModel(inner=model, policy=policy, admit=admit)
+
+    def report(self) -> dict:
+        return {name: policy.report() for name, policy in self.policies.items()}
+
+
+hedge_stats = HedgeStats()
+
+
+if __name__ == "__main__":
+    # 用注入延迟的本地假模型对比：不对冲 vs 对冲 的 TTFT 分布、对冲比例和输出一致性
+    import random
+
+    from langchain_core.messages import AIMessageChunk, HumanMessage
+
+    class SlowFakeChatModel(BaseChatModel):
+        """Streams a fixed answer; `stall_rate` of calls stall for `stall` seconds before the first token."""
+
+        stall: float = 1.0
+        stall_rate: float = 0.05
+        rng: Any = None
+        aborted: int = 0  # 在等待期间被取消的请求数
+
+        @property
+        def _llm_type(self) -> str:
+            return "slow-fake"
+
+        def _delay(self):
+            return self.stall if self.rng.random() < self.stall_rate else self.rng.uniform(0.01, 0.03)
+
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self._delay())
+            for token in ["hedged", " ", "answer"]:
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            try:
+                await asyncio.sleep(self._delay())
+            except asyncio.CancelledError:
+                self.aborted += 1
+                raise
+            for token in ["hedged", " ", "answer"]:
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    def measure(model, n=300):
+        ttfts = []
+        for _ in range(n):
+            start = time.perf_counter()
+            stream = model.stream([HumanMessage(content="hi")])
+            first = next(stream)
+            ttfts.append(time.perf_counter() - start)
+            content = first.content + "".join(chunk.content for chunk in stream)
+            assert content == "hedged answer", content
+        ttfts.sort()
+        return {p: round(ttfts[int(p * (len(ttfts) - 1))] * 1000, 1) for p in (0.5, 0.95, 0.99)}
+
+    base = SlowFakeChatModel(rng=random.Random(0))
+    print("baseline TTFT ms:", measure(base))
+    hedged = HedgedChatModel(inner=SlowFakeChatModel(rng=random.Random(0)), policy=HedgePolicy(initial_delay=0.1))
+    print("hedged   TTFT ms:", measure(hedged))
+    print("policy:", hedged.policy.report())
+    assert hedged.policy.report()["hedge_rate"] <= hedged.policy.max_hedge_rate + 0.01
+    assert hedged.invoke([HumanMessage(content="hi")]).content == "hedged answer"
+    # 卡住的主请求输掉后必须立即被中止，而不是一直挂到 stall 结束
+    time.sleep(0.05)
+    print("aborted losing attempts:", hedged.inner.aborted)
+    assert hedged.inner.aborted >= hedged.policy.hedge_wins > 0
+
+    # 调度器在外层：排队等配额的时间不算进 TTFT，不会因为本地限流触发对冲
+    from llm_scheduler import INTERACTIVE, LLMScheduler, ScheduledChatModel
+
+    scheduler = LLMScheduler(rpm=120, tpm=1_000_000)
+    scheduler.requests.level = 0  # 每次调用先排队约 0.5 秒
+    policy = HedgePolicy(initial_delay=0.1)
+    scheduled = ScheduledChatModel(inner=HedgedChatModel(inner=SlowFakeChatModel(rng=random.Random(0), stall_rate=0.0),
+                                                         policy=policy), priority=INTERACTIVE, scheduler=scheduler)
+    for _ in range(3):
+        assert scheduled.invoke([HumanMessage(content="hi")]).content == "hedged answer"
+    assert policy.hedges == 0 and max(policy._ttfts) < 0.1, policy.report()
+    # 申请不到备份请求的配额时不对冲，主请求照常完成
+    refused = HedgedChatModel(inner=SlowFakeChatModel(rng=random.Random(0), stall=0.3, stall_rate=1.0),
+                              policy=HedgePolicy(initial_delay=0.1), admit=lambda messages: None)
+    assert refused.invoke([HumanMessage(content="hi")]).content == "hedged answer"
+    assert refused.policy.hedges == 0
+    # 放行的备份请求不论胜负，结束后都要释放配额
+    released = []
+    admitted = HedgedChatModel(inner=SlowFakeChatModel(rng=random.Random(1), stall=0.3, stall_rate=0.5),
+                               policy=HedgePolicy(initial_delay=0.1, max_hedge_rate=1.0),
+                               admit=lambda messages: lambda: released.append(1))
+    measure(admitted, n=20)
+    time.sleep(0.5)
+    assert admitted.policy.hedges > 0 and len(released) == admitted.policy.hedges, (len(released), admitted.policy.report())
+    print("hedging check passed")
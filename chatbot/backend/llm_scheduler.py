@@ -0,0 +1,521 @@
+# llm_scheduler.py
+"""
+上游模型调用的限流 + 优先级调度（进程内共享）。
+
+同一个 DeepSeek 账号上，交互式对话、时效性分类和批量任务（例如菜谱生成）互相抢配额；超过 RPM/TPM 后
+交互式请求也会被 429 重试拖慢。所有模型调用都先经过这里：
+1. 两个令牌桶：每分钟请求数（RPM）和每分钟 token 数（TPM），容量为一分钟的配额
+2. 发送前估算 token 成本（prompt + 工具 schema + 最大输出 token），先从 TPM 桶里预留，返回后按实际用量多退少补
+3. 优先级 interactive > classifier > batch：高优先级先放行；低优先级只能在桶里还留有余量时使用，
+   给交互式请求的突发留出空间
+4. 同一优先级内按 flow（会话 thread_id / 任务名）轮转，一个长会话或一个批量任务不会占满整个队列
+5. 上游返回 429 时清空请求桶，等重新积累配额后再放行
+6. 每个优先级的排队时间（p50/p95/max）、队列长度、预估和实际 token 数都可以导出
+
+限额按进程计算：多进程模式（dispatcher.py）下请把 LLM_RPM / LLM_TPM 设为账号配额除以 worker 数。
+其他进程里的批量任务用 RemoteScheduler 在聊天服务的令牌桶里排队（/api/llm-scheduler/*，需要 ADMIN_TOKEN），
+否则它们各自限流，挡不住对交互式请求的挤占。
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage, BaseMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langgraph.config import get_config
+
+from prompt_assembly import estimate_tokens
+
+INTERACTIVE = "interactive"
+CLASSIFIER = "classifier"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, CLASSIFIER, BATCH)
+
+# 放行后桶里至少要剩下的比例：低优先级不能把配额用到底
+RESERVES = {INTERACTIVE: 0.0, CLASSIFIER: 0.05, BATCH: 0.25}
+# 排队超过该时间（秒）直接报错，None 表示一直等
+MAX_WAIT = {INTERACTIVE: 30.0, CLASSIFIER: 30.0, BATCH: None}
+DEFAULT_MAX_OUTPUT_TOKENS = 1000
+
+
+class TokenBucket:
+    """Continuously refilled bucket; the level may go negative after under-estimated calls."""
+
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def can_take(self, amount: float, reserve: float = 0.0) -> bool:
+        return self.level - amount >= reserve * self.capacity
+
+    def seconds_until(self, amount: float, reserve: float = 0.0) -> float:
+        missing = amount + reserve * self.capacity - self.level
+        return max(0.0, missing / self.rate) if self.rate > 0 else float("inf")
+
+
+class _Ticket:
+    __slots__ = ("priority", "flow", "tokens", "enqueued", "granted", "cancelled")
+
+    def __init__(self, priority, flow, tokens):
+        self.priority = priority
+        self.flow = flow
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+
+
+class SchedulerTimeout(TimeoutError):
+    pass
+
+
+class LLMScheduler:
+    """RPM/TPM token buckets with strict priority classes and per-flow round robin within a class."""
+
+    def __init__(self, rpm: float, tpm: float, reserves=None, max_wait=None, window=500):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.reserves = dict(RESERVES, **(reserves or {}))
+        self.max_wait = dict(MAX_WAIT, **(max_wait or {}))
+        self._cond = threading.Condition()
+        # 每个优先级：flow -> 该 flow 的排队请求；OrderedDict 的顺序就是轮转顺序
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._waits = {priority: deque(maxlen=window) for priority in PRIORITIES}
+        self._counters = {priority: {"granted": 0, "timeouts": 0, "estimated_tokens": 0, "actual_tokens": 0}
+                          for priority in PRIORITIES}
+        self.rate_limited = 0
+
+    def _head(self, priority):
+        queue = self._queues[priority]
+        while queue:
+            flow, tickets = next(iter(queue.items()))
+            while tickets and tickets[0].cancelled:
+                tickets.popleft()  # 已超时放弃的请求
+            if tickets:
+                return tickets[0]
+            del queue[flow]
+        return None
+
+    def _dispatch(self) -> float | None:
+        """Grant as many queued tickets as the buckets allow; return seconds until the next may fit."""
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        while True:
+            for priority in PRIORITIES:
+                ticket = self._head(priority)
+                if ticket is not None:
+                    break
+            else:
+                return None
+            reserve = self.reserves[priority]
+            # 超过桶容量的请求按容量计，否则永远放行不了
+            cost = min(ticket.tokens, self.tokens.capacity * (1 - reserve))
+            if not (self.requests.can_take(1, reserve) and self.tokens.can_take(cost, reserve)):
+                # 队首放不下就整体等待：不让低优先级插到前面把配额用掉
+                return max(self.requests.seconds_until(1, reserve), self.tokens.seconds_until(cost, reserve), 0.001)
+            self.requests.level -= 1
+            self.tokens.level -= ticket.tokens
+            queue = self._queues[priority]
+            tickets = queue.pop(ticket.flow)
+            tickets.popleft()
+            if tickets:
+                queue[ticket.flow] = tickets  # 重新放到末尾：同优先级的其他 flow 先走
+            ticket.granted = True
+            counters = self._counters[priority]
+            counters["granted"] += 1
+            counters["estimated_tokens"] += ticket.tokens
+            self._waits[priority].append(now - ticket.enqueued)
+            self._cond.notify_all()
+
+    def acquire(self, priority: str, tokens: int, flow: str = "default"):
+        """Block until a call estimated at `tokens` tokens may be sent."""
+        ticket = _Ticket(priority, flow, tokens)
+        max_wait = self.max_wait[priority]
+        with self._cond:
+            self._queues[priority].setdefault(flow, deque()).append(ticket)
+            while True:
+                wait = self._dispatch()
+                if ticket.granted:
+                    return
+                elapsed = time.monotonic() - ticket.enqueued
+                if max_wait is not None and elapsed >= max_wait:
+                    ticket.cancelled = True
+                    self._counters[priority]["timeouts"] += 1
+                    self._dispatch()  # 让后面的请求顶上来
+                    raise SchedulerTimeout(f"{priority} LLM call waited {elapsed:.1f}s for rate limit budget")
+                if max_wait is not None:
+                    wait = min(wait or max_wait, max_wait - elapsed)
+                self._cond.wait(wait)
+
+    def try_acquire(self, priority: str, tokens: int) -> bool:
+        """
+        Take budget for an optional extra call (e.g. a hedge) only if it fits right now and nobody of
+        the same or a higher priority is queued; never waits.
+        """
+        with self._cond:
+            self._dispatch()
+            if any(self._head(p) is not None for p in PRIORITIES[:PRIORITIES.index(priority) + 1]):
+                return False  # 正在排队等配额：额外的请求只会让排队更久
+            reserve = self.reserves[priority]
+            cost = min(tokens, self.tokens.capacity * (1 - reserve))
+            if not (self.requests.can_take(1, reserve) and self.tokens.can_take(cost, reserve)):
+                return False
+            self.requests.level -= 1
+            self.tokens.level -= tokens
+            counters = self._counters[priority]
+            counters["granted"] += 1
+            counters["estimated_tokens"] += tokens
+            return True
+
+    def settle(self, priority: str, estimated: int, actual: int | None):
+        """Correct the TPM bucket once the real usage is known."""
+        if actual is None:
+            return
+        with self._cond:
+            self.tokens.level += estimated - actual
+            self._counters[priority]["actual_tokens"] += actual
+            self._cond.notify_all()
+
+    def penalize(self):
+        """Upstream said 429: stop granting until a request's worth of budget has refilled."""
+        with self._cond:
+            self.rate_limited += 1
+            self.requests.refill(time.monotonic())
+            self.requests.level = min(self.requests.level, 0.0)
+        print("[llm-scheduler] upstream rate limited, pausing")
+
+    def report(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            classes = {}
+            for priority in PRIORITIES:
+                waits = sorted(self._waits[priority])
+                pct = lambda p: round(waits[min(len(waits) - 1, int(p * len(waits)))], 3) if waits else None
+                classes[priority] = dict(
+                    self._counters[priority],
+                    queued=sum(len(tickets) for tickets in self._queues[priority].values()),
+                    wait_p50_s=pct(0.5), wait_p95_s=pct(0.95), wait_max_s=round(waits[-1], 3) if waits else None,
+                )
+            return {
+                "rpm_available": round(self.requests.level, 1),
+                "tpm_available": round(self.tokens.level),
+                "rate_limited": self.rate_limited,
+                "classes": classes,
+            }
+
+
+llm_scheduler = LLMScheduler(
+    rpm=float(os.environ.get("LLM_RPM", "120")),
+    tpm=float(os.environ.get("LLM_TPM", "200000")),
+)
+
+
+class RemoteScheduler:
+    """
+    Scheduler client for another process (e.g. a batch job): acquire/settle/penalize go to the chat
+    server's /api/llm-scheduler endpoints, so its calls queue in the same buckets as the chat traffic.
+    """
+
+    def __init__(self, base_url: str, admin_token: str, timeout: float = 10.0):
+        import httpx
+
+        from admin_auth import ADMIN_HEADER
+
+        self._client = httpx.Client(base_url=base_url.rstrip("/"), headers={ADMIN_HEADER: admin_token}, timeout=timeout)
+
+    def acquire(self, priority: str, tokens: int, flow: str = "default"):
+        # 批量任务在服务端可能排很久，不设超时
+        response = self._client.post("/api/llm-scheduler/acquire", timeout=None,
+                                     json={"priority": priority, "tokens": tokens, "flow": flow})
+        response.raise_for_status()
+
+    def try_acquire(self, priority: str, tokens: int) -> bool:
+        return False  # 远程没有不等待的预留：不对冲
+
+    def settle(self, priority: str, estimated: int, actual: int | None):
+        if actual is None:
+            return
+        response = self._client.post("/api/llm-scheduler/settle",
+                                     json={"priority": priority, "estimated": estimated, "actual": actual})
+        response.raise_for_status()
+
+    def penalize(self):
+        self._client.post("/api/llm-scheduler/penalize").raise_for_status()
+
+
+def _bound_kwargs(model) -> dict:
+    """kwargs bound with `.bind(...)` / `.bind_tools(...)` (tools, tool_choice, ...), also under wrapper models."""
+    kwargs = {}
+    while True:
+        if hasattr(model, "bound"):
+            kwargs = {**getattr(model, "kwargs", {}), **kwargs}
+            model = model.bound
+        elif hasattr(model, "inner"):  # HedgedChatModel 等包装模型
+            model = model.inner
+        else:
+            return kwargs
+
+
+def _max_output_tokens(model) -> int:
+    while hasattr(model, "bound") or hasattr(model, "inner"):
+        model = model.bound if hasattr(model, "bound") else model.inner
+    return getattr(model, "max_tokens", None) or DEFAULT_MAX_OUTPUT_TOKENS
+
+
+def _current_flow(run_manager) -> str:
+    """The graph run's thread_id (configurable), else `metadata["thread_id"]`, else "default"."""
+    try:
+        flow = get_config().get("configurable", {}).get("thread_id")
+    except RuntimeError:  # 不在任何 runnable 上下文里
+        flow = None
+    if flow is None and run_manager is not None:
+        flow = run_manager.metadata.get("thread_id")
+    return str(flow or "default")
+
+
+def estimate_call_tokens(model, messages: list[BaseMessage]) -> int:
+    """Prompt + bound tool schemas + the maximum completion, estimated offline."""
+    prompt = sum(
+        estimate_tokens(m.content if isinstance(m.content, str) else json.dumps(m.content, ensure_ascii=False)) + 4
+        for m in messages
+    )
+    tools = _bound_kwargs(model).get("tools")
+    if tools:
+        prompt += estimate_tokens(json.dumps(tools, ensure_ascii=False, default=str))
+    return prompt + _max_output_tokens(model)
+
+
+def extra_call_admission(model, priority: str, scheduler=None):
+    """
+    `admit(messages)` for HedgedChatModel: reserve budget for a backup request without waiting and
+    return the callback that refunds the token reservation once that attempt ends (None if refused).
+    The winner's real usage is settled by the ScheduledChatModel around the hedger; a cancelled
+    loser's usage is unknown, so only its request slot stays spent.
+    """
+    scheduler = scheduler or llm_scheduler
+
+    def admit(messages):
+        estimated = estimate_call_tokens(model, messages)
+        if not scheduler.try_acquire(priority, estimated):
+            return None
+        return lambda: scheduler.settle(priority, estimated, 0)
+
+    return admit
+
+
+# record_queue_wait() 打开的收集列表：ScheduledChatModel 把每次排队等待的秒数追加进去
+_queue_waits: ContextVar[list | None] = ContextVar("llm_queue_waits", default=None)
+
+
+@contextmanager
+def record_queue_wait():
+    """Collect the seconds that ScheduledChatModel calls inside the block spend waiting for budget."""
+    waits = []
+    token = _queue_waits.set(waits)
+    try:
+        yield waits
+    finally:
+        _queue_waits.reset(token)
+
+
+def _is_rate_limit_error(error: BaseException) -> bool:
+    return getattr(error, "status_code", None) == 429 or "RateLimit" in type(error).__name__
+
+
+# 内层调用不挂回调：token 流、astream_events 等由外层（本模型）统一上报，否则每个 chunk 会出现两次
+_DETACHED = {"callbacks": []}
+
+
+class ScheduledChatModel(BaseChatModel):
+    """Chat model wrapper that waits for `scheduler` budget before every upstream call."""
+
+    inner: Any  # 任意可 .invoke / .stream(messages) 的 runnable
+    priority: str = INTERACTIVE
+    scheduler: Any = None
+
+    def model_post_init(self, __context):
+        if self.scheduler is None:
+            self.scheduler = llm_scheduler
+
+    @property
+    def _llm_type(self) -> str:
+        return "scheduled-chat-model"
+
+    def bind_tools(self, tools, **kwargs):
+        # 让 with_structured_output 等基于 bind_tools 的用法仍然经过调度
+        return ScheduledChatModel(inner=self.inner.bind_tools(tools, **kwargs), priority=self.priority,
+                                  scheduler=self.scheduler)
+
+    def _acquire(self, messages, run_manager) -> int:
+        estimated = estimate_call_tokens(self.inner, messages)
+        start = time.monotonic()
+        self.scheduler.acquire(self.priority, estimated, flow=_current_flow(run_manager))
+        waits = _queue_waits.get()
+        if waits is not None:
+            waits.append(time.monotonic() - start)
+        return estimated
+
+    def _call_failed(self, error):
+        if _is_rate_limit_error(error):
+            self.scheduler.penalize()
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if stop is not None:
+            kwargs["stop"] = stop
+        estimated = self._acquire(messages, run_manager)
+        try:
+            message = self.inner.invoke(messages, config=_DETACHED, **kwargs)
+        except Exception as e:
+            self._call_failed(e)
+            raise
+        usage = getattr(message, "usage_metadata", None) or {}
+        self.scheduler.settle(self.priority, estimated, usage.get("total_tokens"))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        if stop is not None:
+            kwargs["stop"] = stop
+        estimated = self._acquire(messages, run_manager)
+        actual = None
+        try:
+            for chunk in self.inner.stream(messages, config=_DETACHED, **kwargs):
+                if not isinstance(chunk, BaseMessageChunk):
+                    # 内层模型不支持流式时 stream 退化为 invoke，给出的是一条完整消息
+                    chunk = AIMessageChunk(**chunk.model_dump(exclude={"type"}))
+                usage = getattr(chunk, "usage_metadata", None)
+                if usage:
+                    actual = (actual or 0) + usage.get("total_tokens", 0)
+                yield ChatGenerationChunk(message=chunk)
+        except Exception as e:
+            self._call_failed(e)
+            raise
+        finally:
+            self.scheduler.settle(self.priority, estimated, actual)
+
+
+if __name__ == "__main__":
+    # 模拟：批量任务先把队列塞满，随后交互式和分类请求陆续到达；检查优先级、公平轮转和速率上限
+    from concurrent.futures import ThreadPoolExecutor
+
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from langchain_core.messages import HumanMessage
+
+    scheduler = LLMScheduler(rpm=1200, tpm=1_000_000)  # 每秒 20 个请求，桶容量按 2 秒的突发算
+    scheduler.requests.capacity = scheduler.requests.level = 40
+    granted_at = []
+
+    def call(priority, flow):
+        model = ScheduledChatModel(inner=FakeListChatModel(responses=["ok"]), priority=priority, scheduler=scheduler)
+        start = time.monotonic()
+        model.invoke([HumanMessage(content="hi")], config={"metadata": {"thread_id": flow}})
+        granted_at.append((time.monotonic(), priority, flow))
+        return time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=200) as pool:
+        batch = [pool.submit(call, BATCH, f"job-{i % 2}") for i in range(120)]
+        time.sleep(0.5)
+        interactive = [pool.submit(call, INTERACTIVE, f"thread-{i % 5}") for i in range(20)]
+        classifier = [pool.submit(call, CLASSIFIER, f"thread-{i % 5}") for i in range(20)]
+        waits = {name: sorted(f.result() for f in futures)
+                 for name, futures in [(INTERACTIVE, interactive), (CLASSIFIER, classifier), (BATCH, batch)]}
+
+    for name, w in waits.items():
+        print(f"{name:>12}: p50 {w[len(w) // 2] * 1000:7.0f} ms   max {w[-1] * 1000:7.0f} ms")
+    report = scheduler.report()
+    print(json.dumps(report, indent=2))
+    assert waits[INTERACTIVE][-1] < waits[BATCH][-1]
+    assert waits[INTERACTIVE][len(waits[INTERACTIVE]) // 2] < waits[CLASSIFIER][len(waits[CLASSIFIER]) // 2]
+    # 同一优先级内两个批量任务交替放行
+    jobs = [flow for _, priority, flow in sorted(granted_at) if priority == BATCH][40:60]
+    assert abs(jobs.count("job-0") - jobs.count("job-1")) <= 2, jobs
+    # 任意 1 秒窗口内放行的请求数不超过 速率 + 桶容量
+    times = sorted(t for t, _, _ in granted_at)
+    assert max(sum(1 for t in times if start <= t < start + 1.0) for start in times) <= 20 + 40 + 1
+
+    # 在 graph 里调用时（invoke 和流式），flow 就是 configurable 里的 thread_id，不需要调用方手动传 metadata
+    import asyncio
+
+    from langgraph.graph import START, MessagesState, StateGraph
+
+    flows = []
+    scheduler = LLMScheduler(rpm=1200, tpm=1_000_000)
+    scheduler.acquire = lambda priority, tokens, flow="default": flows.append((priority, flow))
+    classifier_model = ScheduledChatModel(inner=FakeListChatModel(responses=["NO"]), priority=CLASSIFIER, scheduler=scheduler)
+    chat_model = ScheduledChatModel(inner=FakeListChatModel(responses=["ok"]), priority=INTERACTIVE, scheduler=scheduler)
+
+    def node(state):
+        classifier_model.invoke(state["messages"])
+        return {"messages": [chat_model.invoke(state["messages"])]}
+
+    graph = StateGraph(MessagesState).add_node("chat", node).add_edge(START, "chat").compile()
+    graph.invoke({"messages": [HumanMessage(content="hi")]}, {"configurable": {"thread_id": "thread-a"}})
+
+    async def stream_tokens():
+        config = {"configurable": {"thread_id": "thread-b"}}
+        return [chunk async for chunk, _ in graph.astream({"messages": [HumanMessage(content="hi")]}, config,
+                                                        stream_mode="messages")]
+
+    assert asyncio.run(stream_tokens())
+    assert flows == [(CLASSIFIER, "thread-a"), (INTERACTIVE, "thread-a"), (CLASSIFIER, "thread-b"), (INTERACTIVE, "thread-b")], flows
+
+    # 内层模型不支持流式时（stream 退化为 invoke，返回完整的 AIMessage）也能流式调用
+    from langchain_core.language_models.fake_chat_models import FakeMessagesListChatModel
+    from langchain_core.messages import AIMessage
+
+    tool_call = AIMessage(content="", tool_calls=[{"name": "search", "args": {"q": "x"}, "id": "c1", "type": "tool_call"}])
+    non_streaming = ScheduledChatModel(inner=FakeMessagesListChatModel(responses=[tool_call]), scheduler=LLMScheduler(rpm=60, tpm=100_000))
+    chunks = list(non_streaming.stream([HumanMessage(content="hi")]))
+    assert sum(chunks[1:], chunks[0]).tool_calls == tool_call.tool_calls, chunks
+
+    # 备份请求只在马上有配额、且同级和更高优先级都没人排队时放行
+    scheduler = LLMScheduler(rpm=60, tpm=1_000_000)
+    scheduler.requests.level = 2
+    assert scheduler.try_acquire(INTERACTIVE, 100) and scheduler.try_acquire(INTERACTIVE, 100)
+    assert not scheduler.try_acquire(INTERACTIVE, 100)  # 请求桶空了
+    scheduler.requests.level = 10
+    scheduler._queues[INTERACTIVE]["thread-c"] = deque([_Ticket(INTERACTIVE, "thread-c", 2_000_000)])  # TPM 不够
+    assert not scheduler.try_acquire(CLASSIFIER, 100)  # 有更高优先级在排队
+    # 备份请求结束后退还预留的 token
+    scheduler = LLMScheduler(rpm=60, tpm=100_000)
+    admit = extra_call_admission(FakeListChatModel(responses=["ok"]), INTERACTIVE, scheduler)
+    release = admit([HumanMessage(content="hi")])
+    assert release is not None and scheduler.tokens.level < 100_000
+    release()
+    assert scheduler.report()["tpm_available"] == 100_000
+
+    # 排队时间单独记录，调用方可以把它从上游延迟里扣掉
+    scheduler = LLMScheduler(rpm=600, tpm=100_000)  # 每 0.1 秒补一个请求
+    scheduler.requests.level = 0
+    queued = ScheduledChatModel(inner=FakeListChatModel(responses=["ok"]), scheduler=scheduler)
+    with record_queue_wait() as waits:
+        queued.invoke([HumanMessage(content="hi")])
+    assert len(waits) == 1 and 0.05 < waits[0] < 1, waits
+    print("llm scheduler check passed")
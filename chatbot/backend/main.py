@@ -1,24 +1,77 @@
 # main.py
 import asyncio
-import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from typing import AsyncGenerator
 
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 # 导入你的 agent 模块
-from agent import agent
+from admin_auth import require_admin
+from agent import CLIENT_STREAM_NODES, agent, checkpointer
+from circuit_breaker import circuit_breakers
+from llm_scheduler import BATCH, llm_scheduler
+from model_tiers import model_tier_stats
+from prompt_assembly import prompt_cache_stats
+from sse_stream import sse, stream_sse
+from threads import ThreadRegistry, serialize_message
+from tool_results import tool_result_stats, tool_result_store
 
-app = FastAPI(title="LangGraph Chat Agent API", version="1.0")
+# 空闲超过该时间（秒）的会话会被清理，释放 checkpointer 内存
+THREAD_IDLE_TTL = float(os.environ.get("THREAD_IDLE_TTL", str(2 * 3600)))
+thread_registry = ThreadRegistry(checkpointer, idle_ttl=THREAD_IDLE_TTL, side_stores=[tool_result_store])
+
+
+async def expire_idle_threads():
+    while True:
+        await asyncio.sleep(min(60.0, THREAD_IDLE_TTL / 2))
+        thread_registry.expire_idle()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = asyncio.create_task(expire_idle_threads())
+    yield
+    task.cancel()
+
+
+app = FastAPI(title="LangGraph Chat Agent API", version="1.0", lifespan=lifespan)
 
 
 class ChatRequest(BaseModel):
     message: str
-    thread_id: str = "default"  # 用于区分不同会话
+    thread_id: str | None = None  # 服务端签发的会话ID；为空时新建会话，并在 SSE 第一条消息中返回
+
+
+class CreateThreadRequest(BaseModel):
+    thread_id: str | None = None  # 仅供多进程分发器预先分配ID使用
+
+
+class SchedulerAcquireRequest(BaseModel):
+    priority: str = BATCH
+    tokens: int
+    flow: str = "default"
 
 
-async def event_stream(user_input: str, thread_id: str) -> AsyncGenerator[str, None]:
+class SchedulerSettleRequest(BaseModel):
+    priority: str = BATCH
+    estimated: int
+    actual: int | None = None
+
+
+# 其他进程的批量任务排队等配额时占用的线程；与事件循环默认的线程池分开，排队再多也不影响对话
+remote_acquire_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="remote-acquire")
+
+
+def check_remote_priority(priority: str):
+    if priority != BATCH:
+        raise HTTPException(status_code=400, detail="Only batch priority can be scheduled remotely")
+
+
+async def event_stream(user_input: str, thread_id: str, new_thread: bool = False) -> AsyncGenerator[str, None]:
     """
     异步生成器：模拟 agent.stream() 的输出并逐块发送 SSE
     """
@@ -27,27 +80,19 @@ async def event_stream(user_input: str, thread_id: str) -> AsyncGenerator[str, N
     messages = [HumanMessage(content=user_input)]
     config = {"configurable": {"thread_id": thread_id}}
 
+    if new_thread:
+        yield sse("thread", thread_id)
     try:
-        # 遍历 agent 的 stream 输出
-        async for event in agent.astream_events({"messages": messages}, config=config, version="v2"):
-            # 只处理 'on_chain_end' 或 'on_chat_model_stream' 类型事件
-            if event["event"] in ["on_chat_model_stream"]:
-                node_name = event["metadata"].get("langgraph_node", "")
-                chunk = event["data"]["chunk"]
-                content = getattr(chunk, "content", "") if hasattr(chunk, "content") else str(chunk)
-                # [补丁]
-                # 过滤逻辑：如果节点是is_time_sensitive_node，则不输出内容
-                # 这样可以避免时间敏感性判断的YES/NO出现在响应中
-                if content and node_name != "is_time_sensitive_node":
-                    yield f"data: {json.dumps({'type': 'chunk', 'content': content}, ensure_ascii=False)}\n\n"
-                    await asyncio.sleep(0)  # 让出控制权，避免阻塞
+        # 只转发面向用户的节点的 token 和节点发出的流事件（见 sse_stream.py）
+        async for message in stream_sse(agent, {"messages": messages}, config, CLIENT_STREAM_NODES):
+            yield message
+            await asyncio.sleep(0)  # 让出控制权，避免阻塞
 
         # 发送结束标记
-        yield f"data: {json.dumps({'type': 'end', 'content': '[DONE]'}, ensure_ascii=False)}\n\n"
+        yield sse("end", "[DONE]")
 
     except Exception as e:
-        error_msg = f"Error during streaming: {str(e)}"
-        yield f"data: {json.dumps({'type': 'error', 'content': error_msg}, ensure_ascii=False)}\n\n"
+        yield sse("error", f"Error during streaming: {str(e)}")
 
 
 @app.post("/api/chat")
@@ -58,8 +103,17 @@ async def chat_endpoint(request: ChatRequest):
     if not request.message.strip():
         raise HTTPException(status_code=400, detail="Message cannot be empty")
 
+    new_thread = request.thread_id is None
+    if new_thread:
+        thread_id = thread_registry.create()["thread_id"]
+    elif thread_registry.exists(request.thread_id):
+        thread_id = request.thread_id
+    else:
+        raise HTTPException(status_code=404, detail="Thread not found or expired")
+    thread_registry.touch(thread_id)
+
     return StreamingResponse(
-        event_stream(request.message, request.thread_id),
+        event_stream(request.message, thread_id, new_thread),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -69,6 +123,146 @@ async def chat_endpoint(request: ChatRequest):
     )
 
 
+@app.post("/api/threads", status_code=201)
+def create_thread(request: CreateThreadRequest | None = None):
+    """
+    新建会话，返回服务端签发的 thread_id
+    """
+    try:
+        return thread_registry.create(request.thread_id if request else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=409, detail="Thread already exists")
+
+
+@app.get("/api/threads", dependencies=[Depends(require_admin)])
+def list_threads(offset: int = Query(0, ge=0), limit: int = Query(20, ge=1, le=1000)):
+    """
+    按最近活跃时间分页列出所有客户端的会话（仅管理员，见 admin_auth.py）
+    """
+    return thread_registry.page(offset, limit)
+
+
+@app.get("/api/threads/{thread_id}/messages")
+async def get_thread_messages(thread_id: str, offset: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=200)):
+    """
+    分页返回会话历史（从早到晚）
+    """
+    if not thread_registry.exists(thread_id):
+        raise HTTPException(status_code=404, detail="Thread not found or expired")
+    state = await agent.aget_state({"configurable": {"thread_id": thread_id}})
+    history = state.values.get("messages", [])
+    return {
+        "thread_id": thread_id,
+        "total": len(history),
+        "offset": offset,
+        "limit": limit,
+        "items": [serialize_message(m) for m in history[offset:offset + limit]],
+    }
+
+
+@app.get("/api/threads/{thread_id}/tool-results/{tool_call_id}")
+def get_tool_result(thread_id: str, tool_call_id: str):
+    """
+    返回某次工具调用精简前的完整结果
+    """
+    result = tool_result_store.get(thread_id, tool_call_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Tool result not found")
+    return result
+
+
+@app.delete("/api/threads/{thread_id}")
+def delete_thread(thread_id: str):
+    """
+    删除会话及其全部 checkpoint
+    """
+    if not thread_registry.delete(thread_id):
+        raise HTTPException(status_code=404, detail="Thread not found or expired")
+    return {"deleted": thread_id}
+
+
+@app.get("/api/stats/prompt-cache")
+def prompt_cache_stats_endpoint():
+    """
+    按路由返回 prompt token 数和服务端上下文缓存命中 token 数
+    """
+    return prompt_cache_stats.report()
+
+
+@app.get("/api/stats/model-tiers")
+def model_tier_stats_endpoint():
+    """
+    按模型档位返回调用次数、延迟 p50/p95 和升级率
+    """
+    return model_tier_stats.report()
+
+
+@app.get("/api/stats/hedging")
+def hedging_stats_endpoint():
+    """
+    对冲请求统计（需要 LLM_HEDGING=1）：调用数、对冲数、对冲胜出数、当前等待阈值
+    """
+    from hedging import hedge_stats
+
+    return hedge_stats.report()
+
+
+@app.get("/api/stats/circuit-breakers")
+def circuit_breaker_stats_endpoint():
+    """
+    各工具熔断器状态（state_gauge: 0=closed, 1=half_open, 2=open）
+    """
+    return circuit_breakers.report()
+
+
+@app.get("/api/stats/llm-scheduler")
+def llm_scheduler_stats_endpoint():
+    """
+    上游模型调用的限流调度：剩余配额、各优先级的排队时间和 token 用量
+    """
+    return llm_scheduler.report()
+
+
+@app.post("/api/llm-scheduler/acquire", dependencies=[Depends(require_admin)])
+async def llm_scheduler_acquire(request: SchedulerAcquireRequest):
+    """
+    供其他进程（批量任务，见 llm_scheduler.RemoteScheduler）在本服务的令牌桶里排队，放行后返回
+    """
+    check_remote_priority(request.priority)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(remote_acquire_executor, llm_scheduler.acquire, BATCH, request.tokens, request.flow)
+    return {"granted": True}
+
+
+@app.post("/api/llm-scheduler/settle", dependencies=[Depends(require_admin)])
+def llm_scheduler_settle(request: SchedulerSettleRequest):
+    """
+    远程调用结束后按实际 token 用量结算
+    """
+    check_remote_priority(request.priority)
+    llm_scheduler.settle(BATCH, request.estimated, request.actual)
+    return {"settled": True}
+
+
+@app.post("/api/llm-scheduler/penalize", dependencies=[Depends(require_admin)])
+def llm_scheduler_penalize():
+    """
+    远程调用收到上游 429：同一个账号被限流，本服务也暂停放行
+    """
+    llm_scheduler.penalize()
+    return {"penalized": True}
+
+
+@app.get("/api/stats/tool-results")
+def tool_result_stats_endpoint():
+    """
+    各工具结果精简前后的 token 数
+    """
+    return tool_result_stats.report()
+
+
 @app.get("/")
 def root():
     return {"message": "LangGraph Chat Agent is running. POST to /api/chat with {\"message\": \"...\"}"}
@@ -0,0 +1,136 @@
+# model_tiers.py
+"""
+模型分级（cascade）：简单的轮次交给快速、小预算的配置，复杂问题直接用完整配置；
+快速档的回答被截断或明显没把握时，再升级到完整档重答。
+
+- 复杂度估计完全在本地完成（问题长度、结构、近期上下文长度、关键词），不额外调用模型。
+- 每个档位记录延迟（滚动窗口 p50/p95）和升级率；延迟只算调度器放行之后的部分，
+  在本地限流队列里的等待单独记为 queue_wait，不会混进上游延迟里。
+"""
+import re
+import threading
+import time
+from collections import deque
+
+from langchain.messages import AnyMessage, HumanMessage
+
+from llm_scheduler import record_queue_wait
+from prompt_assembly import estimate_tokens
+
+# 档位配置：名称 -> init_chat_model 参数
+# temperature: A higher number makes responses more creative; lower ones make them more deterministic.
+# stream_usage: SSE 路径总是流式调用；不设置时请求不带 stream_options.include_usage，响应里没有 usage，
+# 缓存命中统计和限流调度器的 token 结算都会拿不到数据
+MODEL_TIERS = {
+    "fast": dict(model="deepseek-chat", temperature=0.1, timeout=10, max_tokens=300, max_retries=1, stream_usage=True),
+    "full": dict(model="deepseek-chat", temperature=0.1, timeout=30, max_tokens=1000, max_retries=2, stream_usage=True),
+}
+FAST_TIER = "fast"
+FULL_TIER = "full"
+COMPLEXITY_THRESHOLD = 1.0  # 复杂度 >= 阈值走完整档
+# 上下文只看最近几条消息的长度，且贡献封顶低于阈值：长期会话里的闲聊仍然走快速档
+CONTEXT_WINDOW_MESSAGES = 6
+CONTEXT_TOKENS_PER_POINT = 2000
+CONTEXT_SCORE_CAP = 0.5
+
+_COMPLEX_KEYWORDS = re.compile(
+    r"解释|分析|比较|对比|区别|原理|为什么|如何实现|怎么实现|步骤|详细|代码|证明|推导|优缺点|方案|设计|"
+    r"explain|analy[sz]e|compare|difference|why|how to|implement|step by step|code|prove|design",
+    re.IGNORECASE,
+)
+_LOW_CONFIDENCE = re.compile(
+    r"我不确定|不太确定|无法确定|我不知道|不清楚|无法回答|需要更多信息|"
+    r"i'?m not sure|i don'?t know|not certain|cannot determine",
+    re.IGNORECASE,
+)
+
+
+def estimate_complexity(history: list[AnyMessage]) -> float:
+    """Cheap local estimate of how hard the latest user turn is (0 = chit-chat)."""
+    question = next((m.content for m in reversed(history) if isinstance(m, HumanMessage)), "")
+    if not isinstance(question, str):
+        question = str(question)
+    score = len(question) / 120  # 长问题
+    score += 0.5 * question.count("\n")  # 多行 / 列表
+    if "```" in question:
+        score += 1.0  # 代码块
+    score += 0.5 * len(_COMPLEX_KEYWORDS.findall(question))
+    score += 0.3 * max(0, question.count("?") + question.count("？") - 1)  # 一次问多个问题
+    recent = history[-CONTEXT_WINDOW_MESSAGES - 1:-1]
+    context_tokens = sum(estimate_tokens(m.content if isinstance(m.content, str) else str(m.content)) for m in recent)
+    score += min(CONTEXT_SCORE_CAP, context_tokens / CONTEXT_TOKENS_PER_POINT)  # 近期上下文越长，越需要完整档
+    return score
+
+
+def choose_tier(history: list[AnyMessage]) -> str:
+    return FULL_TIER if estimate_complexity(history) >= COMPLEXITY_THRESHOLD else FAST_TIER
+
+
+def needs_escalation(response) -> str | None:
+    """Return the reason the fast-tier answer should be redone, or None if it is fine."""
+    finish_reason = (getattr(response, "response_metadata", None) or {}).get("finish_reason")
+    if finish_reason == "length":
+        return "truncated"
+    content = response.content if isinstance(response.content, str) else str(response.content)
+    if not content.strip():
+        return "empty"
+    if _LOW_CONFIDENCE.search(content):
+        return "low_confidence"
+    return None
+
+
+class ModelTierStats:
+    """Per-tier call counts, rolling latency and queue-wait percentiles, and escalation rates."""
+
+    def __init__(self, window=500):
+        self._lock = threading.Lock()
+        self._window = window
+        self._tiers = {}
+
+    def _tier(self, tier):
+        return self._tiers.setdefault(tier, {"calls": 0, "escalations": {}, "latencies": deque(maxlen=self._window),
+                                             "queue_waits": deque(maxlen=self._window)})
+
+    def record_call(self, tier: str, latency: float, queue_wait: float = 0.0):
+        with self._lock:
+            stats = self._tier(tier)
+            stats["calls"] += 1
+            stats["latencies"].append(latency)
+            stats["queue_waits"].append(queue_wait)
+
+    def record_escalation(self, tier: str, reason: str):
+        with self._lock:
+            escalations = self._tier(tier)["escalations"]
+            escalations[reason] = escalations.get(reason, 0) + 1
+
+    def report(self) -> dict:
+        with self._lock:
+            report = {}
+            for tier, stats in self._tiers.items():
+                latencies, waits = sorted(stats["latencies"]), sorted(stats["queue_waits"])
+                pct = lambda values, p: round(values[min(len(values) - 1, int(p * len(values)))], 3) if values else None
+                escalated = sum(stats["escalations"].values())
+                report[tier] = {
+                    "calls": stats["calls"],
+                    "latency_p50_s": pct(latencies, 0.5),
+                    "latency_p95_s": pct(latencies, 0.95),
+                    "queue_wait_p50_s": pct(waits, 0.5),
+                    "queue_wait_p95_s": pct(waits, 0.95),
+                    "escalations": dict(stats["escalations"]),
+                    "escalation_rate": round(escalated / stats["calls"], 4) if stats["calls"] else 0.0,
+                }
+            return report
+
+
+model_tier_stats = ModelTierStats()
+
+
+def timed_invoke(tier: str, model, messages):
+    """Invoke `model` and record under `tier` its latency after scheduler admission and its queue wait."""
+    with record_queue_wait() as waits:
+        start = time.perf_counter()
+        try:
+            return model.invoke(messages)
+        finally:
+            queued = sum(waits)
+            model_tier_stats.record_call(tier, time.perf_counter() - start - queued, queued)
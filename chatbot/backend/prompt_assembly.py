@@ -0,0 +1,183 @@
+# prompt_assembly.py
+"""
+前缀稳定的 prompt 组装 + 上下文缓存命中统计。
+
+DeepSeek 会缓存请求的公共前缀（命中部分更便宜、更快），前提是前缀逐字节一致。组装规则：
+1. 静态内容在最前：同一个 SystemMessage 对象（工具 schema 由 bind_tools 固定在请求里）
+2. 会话历史按原样追加，历史里不写入任何会变化的内容
+3. 变化的内容（当前时间等）只在本次请求里临时追加到最末尾，不进入 checkpoint。放在末尾而不是最后一条用户消息之后：
+   下一次请求（工具循环的下一步或下一轮对话）只是在历史后面追加，除了这几条动态消息，上一次请求整个都是它的前缀
+"""
+import re
+import threading
+
+from langchain.messages import AnyMessage, HumanMessage, SystemMessage
+
+
+class PromptAssembler:
+    """Builds `[static system prompt] + history + [dynamic context]` message lists."""
+
+    def __init__(self, system_prompt: str):
+        # 只构建一次，保证每次请求的静态前缀完全一致
+        self.system_message = SystemMessage(content=system_prompt)
+
+    def assemble(self, history: list[AnyMessage], dynamic_context: list[str] | None = None) -> list[AnyMessage]:
+        """
+        Return the messages to send. `dynamic_context` goes after everything else, so each request
+        is the previous one minus its dynamic context plus the newly appended history.
+        """
+        messages = [self.system_message] + list(history)
+        if dynamic_context:
+            messages += [SystemMessage(content=text) for text in dynamic_context]
+        return messages
+
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Offline token estimate without a tokenizer: DeepSeek documents roughly 0.6 tokens per
+    Chinese character and 0.3 tokens per other character.
+    """
+    cjk = len(_CJK_RE.findall(text))
+    return int(0.6 * cjk + 0.3 * (len(text) - cjk)) + 1
+
+
+def cache_hit_tokens(response) -> tuple[int, int]:
+    """Return (prompt_tokens, cache_hit_tokens) from a chat model response."""
+    usage = getattr(response, "usage_metadata", None) or {}
+    prompt_tokens = usage.get("input_tokens", 0)
+    hit = (usage.get("input_token_details") or {}).get("cache_read")
+    if hit is None:
+        # DeepSeek 原生字段
+        token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+        hit = token_usage.get("prompt_cache_hit_tokens", 0)
+        prompt_tokens = prompt_tokens or token_usage.get("prompt_tokens", 0)
+    return prompt_tokens, hit or 0
+
+
+class PromptCacheStats:
+    """Per-route counters of prompt tokens and provider-side cache hits."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route: str, response):
+        prompt_tokens, hit = cache_hit_tokens(response)
+        with self._lock:
+            stats = self._routes.setdefault(route, {"calls": 0, "prompt_tokens": 0, "cache_hit_tokens": 0})
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["cache_hit_tokens"] += hit
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                route: dict(stats, hit_rate=round(stats["cache_hit_tokens"] / stats["prompt_tokens"], 4)
+                            if stats["prompt_tokens"] else 0.0)
+                for route, stats in self._routes.items()
+            }
+
+
+prompt_cache_stats = PromptCacheStats()
+
+
+if __name__ == "__main__":
+    # 用假模型检查：多轮对话 + 工具循环中，每次请求除了上一次末尾的动态内容，都命中上一次请求的全部内容
+    from langchain.messages import AIMessage, ToolMessage
+
+    class PrefixCachingFakeModel:
+        """Fake model that reports cache hits as the longest shared prefix (in messages) with any earlier request."""
+
+        def __init__(self):
+            self.requests = []
+
+        def invoke(self, messages):
+            serialized = [(type(m).__name__, m.content) for m in messages]
+            hit = max((next((i for i, (a, b) in enumerate(zip(prev, serialized)) if a != b), min(len(prev), len(serialized)))
+                       for prev in self.requests), default=0)
+            self.requests.append(serialized)
+            return AIMessage(content="ok", usage_metadata={
+                "input_tokens": len(serialized), "output_tokens": 1, "total_tokens": len(serialized) + 1,
+                "input_token_details": {"cache_read": hit},
+            })
+
+    model = PrefixCachingFakeModel()
+    assembler = PromptAssembler("static system prompt")
+    stats = PromptCacheStats()
+    history = []
+    previous_size = None
+    for turn in range(3):
+        history.append(HumanMessage(content=f"question {turn}"))
+        dynamic = [f"当前日期和时间: 2025-01-0{turn + 1} 12:00:0{turn}"]
+        # 工具循环：第一次调用 -> 工具结果 -> 第二次调用；时间敏感的问题每次请求都带动态内容
+        for step in range(2):
+            request = assembler.assemble(history, dynamic)
+            assert request[0] is assembler.system_message
+            response = model.invoke(request)
+            stats.record("llm_call_with_tools", response)
+            hit = cache_hit_tokens(response)[1]
+            if previous_size is not None:
+                assert hit == previous_size - len(dynamic), (turn, step, hit, previous_size)
+            previous_size = len(request)
+            if step == 0:
+                history += [AIMessage(content="", tool_calls=[{"name": "search", "args": {}, "id": f"call{turn}"}]),
+                            ToolMessage(content=f"result {turn}", tool_call_id=f"call{turn}")]
+        history.append(AIMessage(content=f"answer {turn}"))
+    report = stats.report()["llm_call_with_tools"]
+    print(report)
+    assert report["hit_rate"] > 0.6, report
+    print("prefix stability check passed")
+
+    # SSE 路径：graph 以 messages 模式流式运行，模型经过限流调度器，usage 只在最后一个空 chunk 里
+    # （DeepSeek 开启 stream_options.include_usage 时的行为）；统计和调度器结算都必须拿到它
+    from langchain_core.language_models import BaseChatModel
+    from langchain_core.language_models.chat_models import generate_from_stream
+    from langchain_core.messages import AIMessageChunk
+    from langchain_core.outputs import ChatGenerationChunk
+    from langgraph.graph import END, START, MessagesState, StateGraph
+
+    from llm_scheduler import INTERACTIVE, LLMScheduler, ScheduledChatModel
+    from model_tiers import MODEL_TIERS
+
+    assert all(config.get("stream_usage") for config in MODEL_TIERS.values()), "tiers must request streamed usage"
+
+    class UsageStreamingFakeModel(BaseChatModel):
+        """Fake model that streams its answer and reports usage on a trailing empty chunk."""
+
+        @property
+        def _llm_type(self) -> str:
+            return "usage-streaming-fake"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            for token in ("o", "k"):
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata={
+                "input_tokens": 12, "output_tokens": 2, "total_tokens": 14, "input_token_details": {"cache_read": 8},
+            }))
+
+    scheduler = LLMScheduler(rpm=600, tpm=100_000)
+    model = ScheduledChatModel(inner=UsageStreamingFakeModel(), priority=INTERACTIVE, scheduler=scheduler)
+    stream_stats = PromptCacheStats()
+
+    def llm_call(state: MessagesState):
+        response = model.invoke(assembler.assemble(state["messages"]))
+        stream_stats.record("llm_call", response)
+        return {"messages": [response]}
+
+    graph = StateGraph(MessagesState)
+    graph.add_node(llm_call)
+    graph.add_edge(START, "llm_call")
+    graph.add_edge("llm_call", END)
+    tokens = [chunk.content for chunk, _ in graph.compile().stream({"messages": [HumanMessage(content="hi")]},
+                                                                    stream_mode="messages")]
+    assert "".join(tokens) == "ok", tokens
+    report = stream_stats.report()["llm_call"]
+    assert (report["prompt_tokens"], report["cache_hit_tokens"]) == (12, 8), report
+    assert scheduler.report()["classes"][INTERACTIVE]["actual_tokens"] == 14
+    print("streamed usage check passed")
@@ -0,0 +1,159 @@
+# sse_stream.py
+"""
+把 agent 的一次运行转成 SSE 消息。
+
+之前用 astream_events(version="v2")：每个 chain / 节点 / 模型步骤都会产生开始、结束、流式回调事件，
+绝大部分被直接丢掉，再按写死的节点名过滤掉分类器的 YES/NO。现在直接用 graph 级的流：
+- stream_mode="messages"：模型 token，带所属节点；只转发 allow-list 里的节点
+- stream_mode="custom"：节点通过 emit_event() 发出的事件（升级重答、降级模式）
+"""
+import json
+from typing import AsyncGenerator
+
+from langchain_core.messages import AIMessage
+from langgraph.config import get_stream_writer
+
+
+def sse(type_: str, content) -> str:
+    return f"data: {json.dumps({'type': type_, 'content': content}, ensure_ascii=False)}\n\n"
+
+
+def emit_event(event: str, data: dict):
+    """Send an event to the client stream from inside a node (no-op outside a graph run)."""
+    try:
+        writer = get_stream_writer()
+    except (RuntimeError, KeyError):
+        # 不在 graph 运行上下文中：没有 config 时是 RuntimeError，
+        # 在普通 runnable 里（例如直接 tool.invoke）config 里没有 graph 运行时，是 KeyError
+        return
+    writer({"event": event, **data})
+
+
+async def stream_sse(graph, inputs, config, stream_nodes) -> AsyncGenerator[str, None]:
+    """
+    Run `graph` and yield SSE messages: model tokens from the nodes in `stream_nodes`
+    plus the custom events emitted with `emit_event`.
+    """
+    degraded = False
+    async for mode, payload in graph.astream(inputs, config=config, stream_mode=["messages", "custom"]):
+        if mode == "messages":
+            message, metadata = payload
+            # 只转发模型输出（工具结果等其他消息不发给客户端）
+            if metadata.get("langgraph_node") in stream_nodes and isinstance(message, AIMessage):
+                if isinstance(message.content, str) and message.content:
+                    yield sse("chunk", message.content)
+        # 快速档回答被升级重答：通知前端清空当前回复
+        elif payload["event"] == "tier_escalation":
+            yield sse("reset", payload["reason"])
+        # 工具超时/熔断：本次回答处于降级模式，只通知一次
+        elif payload["event"] == "degraded_mode" and not degraded:
+            degraded = True
+            yield sse("degraded", payload["tool"])
+
+
+if __name__ == "__main__":
+    # 对比 astream_events(v2) + 过滤 与 messages 流 的开销：
+    # - 每 token：一个节点流式输出 N 个 token
+    # - 每 superstep：一串不调用模型的 mock 节点（e0_overview.py 的写法）+ 最后一个模型节点
+    import asyncio
+    import statistics
+    import time
+
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    from langgraph.graph import END, START, MessagesState, StateGraph
+
+    CONFIG = {"recursion_limit": 200}
+
+    async def via_astream_events(graph, inputs, stream_nodes):
+        """The previous main.py loop."""
+        async for event in graph.astream_events(inputs, config=CONFIG, version="v2"):
+            if event["event"] == "on_custom_event":
+                yield sse(event["name"], event["data"])
+            elif event["event"] == "on_chat_model_stream":
+                if event["metadata"].get("langgraph_node", "") in stream_nodes and event["data"]["chunk"].content:
+                    yield sse("chunk", event["data"]["chunk"].content)
+
+    async def via_messages(graph, inputs, stream_nodes):
+        async for message in stream_sse(graph, inputs, CONFIG, stream_nodes):
+            yield message
+
+    def build_graph(n_tokens, n_steps):
+        answer = " ".join(["tok"] * n_tokens)
+
+        def mock_classifier(state: MessagesState):
+            # 真实图里分类器是模型调用，但它的输出不发给客户端
+            model = GenericFakeChatModel(messages=iter([AIMessage(content="NO")]))
+            model.invoke(state["messages"])
+            return {}
+
+        def mock_step(state: MessagesState):
+            return {}
+
+        def mock_llm(state: MessagesState):
+            model = GenericFakeChatModel(messages=iter([AIMessage(content=answer)]))
+            return {"messages": [model.invoke(state["messages"])]}
+
+        graph = StateGraph(MessagesState)
+        graph.add_node(mock_classifier)
+        graph.add_edge(START, "mock_classifier")
+        previous = "mock_classifier"
+        for i in range(n_steps):
+            graph.add_node(f"mock_step_{i}", mock_step)
+            graph.add_edge(previous, f"mock_step_{i}")
+            previous = f"mock_step_{i}"
+        graph.add_node(mock_llm)
+        graph.add_edge(previous, "mock_llm")
+        graph.add_edge("mock_llm", END)
+        return graph.compile()
+
+    async def measure(stream, graph, repeat):
+        inputs = {"messages": [{"role": "user", "content": "hi!"}]}
+        chunks = []
+        start = time.perf_counter()
+        for _ in range(repeat):
+            chunks = [message async for message in stream(graph, inputs, {"mock_llm"})]
+        return (time.perf_counter() - start) / repeat, chunks
+
+    async def run_graph(graph, repeat):
+        inputs = {"messages": [{"role": "user", "content": "hi!"}]}
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await graph.ainvoke(inputs, config=CONFIG)
+        return (time.perf_counter() - start) / repeat
+
+    async def overhead(stream, graph, repeat, rounds=9):
+        """
+        Median over `rounds` of the streaming cost per run (streamed minus plain ainvoke). Baseline and
+        streamed runs alternate within each round, so machine noise hits both sides of the difference.
+        """
+        costs = []
+        for _ in range(rounds):
+            baseline = await run_graph(graph, repeat)
+            elapsed, chunks = await measure(stream, graph, repeat)
+            costs.append(elapsed - baseline)
+        return statistics.median(costs), chunks
+
+    async def main():
+        streams = {"astream_events": via_astream_events, "messages": via_messages}
+        # 每 token 开销：token 数从 100 增加到 1000，斜率就是每个 token 的成本（扣除不流式的 ainvoke 基线）
+        print("per-token overhead (1 model node, 0 extra supersteps)")
+        per_token = {}
+        for name, stream in streams.items():
+            costs = {}
+            for n_tokens in (100, 1000):
+                costs[n_tokens], chunks = await overhead(stream, build_graph(n_tokens, 0), 5)
+                assert len(chunks) == 2 * n_tokens - 1, (name, len(chunks))  # token 和空格各一个 chunk
+            per_token[name] = (costs[1000] - costs[100]) / (2 * 900) * 1e6
+            print(f"  {name:>15}: {per_token[name]:6.1f} µs per streamed chunk")
+
+        # 每 superstep 开销：mock 节点从 0 增加到 50；单次差值只有毫秒级，所以多跑几次
+        print("per-superstep overhead (10 tokens)")
+        for name, stream in streams.items():
+            costs = {}
+            for n_steps in (0, 50):
+                costs[n_steps], chunks = await overhead(stream, build_graph(10, n_steps), 20)
+                assert "YES" not in "".join(chunks) and "NO" not in "".join(chunks)
+            print(f"  {name:>15}: {(costs[50] - costs[0]) / 50 * 1e6:6.1f} µs per superstep")
+        assert per_token["messages"] < per_token["astream_events"]
+
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+# threads.py
+"""
+会话（thread）生命周期管理。
+
+- thread_id 由服务端签发（uuid4 hex），每个客户端使用自己的 thread，不再共用 "default"。
+- 记录每个 thread 的创建时间、最后活跃时间和轮数，支持分页列出。
+- 空闲超过 THREAD_IDLE_TTL 秒的 thread 会被清理：从 checkpointer 中删除全部 checkpoint，真正释放内存。
+"""
+import re
+import threading
+import time
+import uuid
+
+THREAD_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class ThreadRegistry:
+    """In-process registry of live threads backed by the graph's checkpointer."""
+
+    def __init__(self, checkpointer, idle_ttl: float, side_stores=()):
+        self.checkpointer = checkpointer
+        self.side_stores = list(side_stores)  # 其他按 thread 保存数据的存储，需提供 delete_thread(thread_id)
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    def create(self, thread_id: str | None = None) -> dict:
+        """Register a new thread; `thread_id` lets the dispatcher pre-assign an id."""
+        if thread_id is None:
+            thread_id = uuid.uuid4().hex
+        elif not THREAD_ID_PATTERN.match(thread_id):
+            raise ValueError("thread_id must be 32 lowercase hex characters")
+        now = time.time()
+        with self._lock:
+            if thread_id in self._threads:
+                raise KeyError(thread_id)
+            info = self._threads[thread_id] = {
+                "thread_id": thread_id, "created_at": now, "last_active": now, "turns": 0,
+            }
+            return dict(info)
+
+    def exists(self, thread_id: str) -> bool:
+        with self._lock:
+            return thread_id in self._threads
+
+    def touch(self, thread_id: str):
+        """Mark a thread active and count one turn."""
+        with self._lock:
+            info = self._threads[thread_id]
+            info["last_active"] = time.time()
+            info["turns"] += 1
+
+    def page(self, offset: int = 0, limit: int = 20) -> dict:
+        """Threads ordered by most recent activity."""
+        with self._lock:
+            items = sorted(self._threads.values(), key=lambda t: t["last_active"], reverse=True)
+            return {"total": len(items), "offset": offset, "limit": limit,
+                    "items": [dict(t) for t in items[offset:offset + limit]]}
+
+    def delete(self, thread_id: str) -> bool:
+        with self._lock:
+            existed = self._threads.pop(thread_id, None) is not None
+        # 即使注册表里没有（例如服务重启前的旧 id），也清理 checkpointer
+        self.checkpointer.delete_thread(thread_id)
+        for store in self.side_stores:
+            store.delete_thread(thread_id)
+        return existed
+
+    def expire_idle(self) -> list[str]:
+        """Delete threads idle for longer than `idle_ttl`; returns the expired ids."""
+        cutoff = time.time() - self.idle_ttl
+        with self._lock:
+            expired = [tid for tid, t in self._threads.items() if t["last_active"] < cutoff]
+        for thread_id in expired:
+            self.delete(thread_id)
+        if expired:
+            print(f"[threads] expired {len(expired)} idle threads")
+        return expired
+
+
+def serialize_message(message) -> dict:
+    """Client-facing view of a checkpointed message."""
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return {"type": message.type, "content": content}
@@ -0,0 +1,222 @@
+# tool_results.py
+"""
+工具结果精简：tool_node 的输出先精简，再交给模型。
+
+原始搜索结果（Tavily 的 JSON、本地检索的多段文本）在同一轮的工具循环里会反复发给模型，
+还会留在会话历史里跟着以后每一轮一起发送。精简规则：
+1. 结果本身不超过预算 -> 原样保留
+2. 切成句子/段落，去掉样板内容（导航、版权、登录提示、重复句子、纯符号行）
+3. 按与问题 + 工具参数的词重叠打分，在 token 预算内挑出最相关的片段，按原顺序、按来源输出
+4. 完整结果按 (thread_id, tool_call_id) 存在旁路存储里，不进入 checkpoint，会话删除/过期时一起清理
+"""
+import json
+import math
+import re
+import threading
+import time
+
+from bm25_index import tokenize
+from prompt_assembly import estimate_tokens
+
+_SPLIT_RE = re.compile(r"(?<=[。！？；!?;])|(?<=\.)\s+|\n+")
+_BOILERPLATE_RE = re.compile(
+    r"cookie|privacy policy|terms of (use|service)|all rights reserved|copyright|©|subscribe|sign (in|up)|log ?in|"
+    r"skip to (main )?content|advertisement|share (this|on)|click here|read more|related (articles|posts)|"
+    r"版权所有|免责声明|隐私政策|用户协议|登录|注册|订阅|广告|分享到|点击查看|阅读全文|相关阅读|相关推荐|返回顶部|扫码|关注我们",
+    re.IGNORECASE,
+)
+_NAV_SEPARATOR_RE = re.compile(r"\s[>|»/·]\s")
+_WORD_RE = re.compile(r"\w")
+MIN_SNIPPET_CHARS = 8
+NO_SNIPPET_NOTE = "（结果中没有可用的正文片段，以下是原始结果的开头）"
+
+
+def parse_sources(content: str) -> list[dict]:
+    """Split a tool payload into sources: Tavily results, `\\n\\n`-separated hits, or one plain text."""
+    try:
+        payload = json.loads(content)
+    except ValueError:
+        payload = None
+    if isinstance(payload, dict) and isinstance(payload.get("results"), list):
+        return [
+            {"title": r.get("title") or "", "url": r.get("url") or "", "text": r.get("content") or ""}
+            for r in payload["results"] if isinstance(r, dict)
+        ]
+    sources = []
+    for block in content.split("\n\n"):
+        # 本地检索的每条结果第一行是 "[score] source"
+        header, _, body = block.partition("\n")
+        if header.startswith("[") and body:
+            sources.append({"title": header, "url": "", "text": body})
+        elif block.strip():
+            sources.append({"title": "", "url": "", "text": block})
+    return sources
+
+
+def is_boilerplate(snippet: str) -> bool:
+    if len(snippet) < MIN_SNIPPET_CHARS or len(_WORD_RE.findall(snippet)) < len(snippet) / 2:
+        return True  # 太短，或者大部分是符号（表格分隔线等）
+    if len(_NAV_SEPARATOR_RE.findall(snippet)) >= 2:
+        return True  # 面包屑 / 导航栏
+    return len(snippet) < 200 and _BOILERPLATE_RE.search(snippet) is not None
+
+
+def condense(content: str, query: str, budget: int) -> str:
+    """Keep the snippets of `content` most relevant to `query` within about `budget` tokens."""
+    if estimate_tokens(content) <= budget:
+        return content
+    query_terms = set(tokenize(query))
+    candidates = []  # (overlap, score, source index, snippet index, text)
+    seen = set()
+    sources = parse_sources(content)
+    for s, source in enumerate(sources):
+        for i, snippet in enumerate(_SPLIT_RE.split(source["text"])):
+            snippet = (snippet or "").strip()
+            key = snippet.lower()
+            if key in seen or is_boilerplate(snippet):
+                continue
+            seen.add(key)
+            terms = set(tokenize(snippet))
+            overlap = len(query_terms & terms)
+            # 重叠词越多越好，长句子略微降权；排名靠前的来源略微加权
+            score = overlap / math.log2(len(terms) + 2) + 0.05 / (s + 1)
+            candidates.append((overlap, score, s, i, snippet))
+    if any(c[0] for c in candidates):
+        # 有相关片段时不用无关内容填满预算
+        candidates = [c for c in candidates if c[0]]
+
+    header_tokens = {s: estimate_tokens(f"{src['title']} {src['url']}") + 2 for s, src in enumerate(sources)}
+    chosen = []
+    used = 0
+    for _, score, s, i, snippet in sorted(candidates, key=lambda c: -c[1]):
+        cost = estimate_tokens(snippet) + (header_tokens[s] if all(c[0] != s for c in chosen) else 0)
+        if used + cost > budget:
+            if chosen:
+                continue
+            # 第一个片段就超出预算：按比例截断
+            snippet = snippet[:max(1, int(len(snippet) * budget / cost))]
+            cost = budget
+        chosen.append((s, i, snippet))
+        used += cost
+
+    if not chosen:
+        # 全是样板内容或过短的片段：不给模型空结果，保留原始结果开头（按预算截断）
+        room = max(1, budget - estimate_tokens(NO_SNIPPET_NOTE))
+        return f"{NO_SNIPPET_NOTE}\n{content[:max(1, int(len(content) * room / estimate_tokens(content)))]}"
+
+    lines = []
+    current = None
+    for s, i, snippet in sorted(chosen):
+        if s != current:
+            current = s
+            header = " ".join(part for part in (sources[s]["title"], sources[s]["url"] and f"({sources[s]['url']})") if part)
+            if header:
+                lines.append(f"## {header}")
+        lines.append(f"- {snippet}")
+    return "\n".join(lines)
+
+
+class ToolResultStore:
+    """Full tool payloads kept outside the checkpoint, keyed by thread and tool call id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    def put(self, thread_id: str, tool_call_id: str, tool_name: str, content: str):
+        with self._lock:
+            self._threads.setdefault(thread_id, {})[tool_call_id] = {
+                "tool_call_id": tool_call_id, "tool": tool_name, "created_at": time.time(), "content": content,
+            }
+
+    def get(self, thread_id: str, tool_call_id: str) -> dict | None:
+        with self._lock:
+            return self._threads.get(thread_id, {}).get(tool_call_id)
+
+    def delete_thread(self, thread_id: str):
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+
+class ToolResultStats:
+    """Per-tool token counts before and after condensation."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tools = {}
+
+    def record(self, tool_name: str, raw_tokens: int, condensed_tokens: int):
+        with self._lock:
+            stats = self._tools.setdefault(tool_name, {"calls": 0, "condensed": 0, "raw_tokens": 0, "condensed_tokens": 0})
+            stats["calls"] += 1
+            stats["condensed"] += condensed_tokens < raw_tokens
+            stats["raw_tokens"] += raw_tokens
+            stats["condensed_tokens"] += condensed_tokens
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                tool: dict(stats, kept_ratio=round(stats["condensed_tokens"] / stats["raw_tokens"], 4)
+                           if stats["raw_tokens"] else 1.0)
+                for tool, stats in self._tools.items()
+            }
+
+
+tool_result_store = ToolResultStore()
+tool_result_stats = ToolResultStats()
+
+
+def condense_tool_messages(tool_messages, query: str, budget: int, thread_id: str | None = None) -> list:
+    """
+    Condense each ToolMessage to `budget` tokens. The full payload goes to `tool_result_store`
+    (when `thread_id` is known) and can be fetched by its tool_call_id.
+    """
+    condensed = []
+    for message in tool_messages:
+        content = message.content if isinstance(message.content, str) else json.dumps(message.content, ensure_ascii=False)
+        short = condense(content, query, budget)
+        raw_tokens, short_tokens = estimate_tokens(content), estimate_tokens(short)
+        tool_result_stats.record(message.name or "unknown", raw_tokens, short_tokens)
+        if short is content:
+            condensed.append(message)
+            continue
+        if thread_id is not None:
+            tool_result_store.put(thread_id, message.tool_call_id, message.name, content)
+        print(f"[tool-results] {message.name}: {raw_tokens} -> {short_tokens} tokens")
+        condensed.append(message.model_copy(update={"content": short}))
+    return condensed
+
+
+if __name__ == "__main__":
+    # 用一份模拟的 Tavily 结果检查精简效果：token 数、是否保留了答案所在的句子、完整结果是否可取回
+    from langchain.messages import ToolMessage
+
+    filler = "这是一段与问题无关的背景介绍，讲的是公司历史和其他业务。" * 6
+    payload = {
+        "query": "上海 明天 天气",
+        "results": [
+            {"title": "上海天气预报", "url": "https://weather.example.com/shanghai", "score": 0.93,
+             "content": "首页 > 天气 > 上海\n登录 | 注册\n" + filler + "上海明天多云转小雨，气温18到24度，东南风3级。"
+                        + filler + "\n版权所有 © 2025 Example\n| --- | --- |"},
+            {"title": "Shanghai weather", "url": "https://en.example.com/sh", "score": 0.71,
+             "content": "Skip to content. " + "Unrelated news about markets and sports. " * 20
+                        + "Tomorrow in Shanghai: cloudy, light rain later, 18-24°C. Cookie settings"},
+        ],
+        "images": [], "response_time": 1.2, "request_id": "abc",
+    }
+    raw = json.dumps(payload, ensure_ascii=False)
+    message = ToolMessage(content=raw, tool_call_id="call_1", name="tavily_search")
+    [short] = condense_tool_messages([message], "上海明天天气怎么样 Shanghai weather tomorrow", budget=120, thread_id="t1")
+    print(short.content)
+    print(tool_result_stats.report())
+    assert "18到24度" in short.content and "18-24°C" in short.content
+    assert "版权所有" not in short.content and "登录" not in short.content and "首页" not in short.content
+    assert estimate_tokens(short.content) <= 130
+    assert tool_result_store.get("t1", "call_1")["content"] == raw
+    small = ToolMessage(content="本地文档库为空", tool_call_id="call_2", name="local_docs_search")
+    assert condense_tool_messages([small], "x", budget=120)[0] is small
+    # 全是样板内容：不能返回空结果
+    junk = json.dumps({"results": [{"title": "", "url": "https://example.com", "content": "登录 | 注册\n" * 200}]})
+    fallback = condense(junk, "上海天气", budget=120)
+    assert fallback.startswith(NO_SNIPPET_NOTE) and estimate_tokens(fallback) <= 130, fallback
+    print("tool result condensation check passed")
@@ -0,0 +1,366 @@
+# vector_store.py
+## pip install numpy
+"""
+本地向量检索：float16 向量保存在内存映射文件中，查询时分块做批量矩阵乘 + argpartition 取 top-k。
+
+目录结构（VECTOR_STORE_DIR）：
+- vectors.f16   : n x dim 的 float16 向量，只追加
+- docs.jsonl    : 每行一个 {"text": ..., "metadata": {...}}，与向量按行对齐
+- meta.json     : 维度、条数、IVF 覆盖的条数
+- ivf.npz       : 可选的 IVF 粗分区（质心 + 按分区排序的文档下标）
+
+默认的 embedding 函数 `hash_embed` 完全离线（字符 n-gram 哈希），不依赖任何网络服务。
+"""
+import json
+import os
+import threading
+import zlib
+
+import numpy as np
+
+DEFAULT_DIM = 384
+SEARCH_BLOCK_ROWS = 16384  # 分块大小：控制 float16 -> float32 转换时的临时内存
+
+
+##---------------------------------------------------
+## (1) Offline embedding function
+##---------------------------------------------------
+def hash_embed(texts, dim=DEFAULT_DIM, ngram_range=(1, 3)):
+    """
+    把文本映射为 L2 归一化的 float32 向量（带符号的字符 n-gram 特征哈希）。
+    使用 crc32 而不是内置 hash()，保证跨进程结果一致。
+    """
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    lo, hi = ngram_range
+    for row, text in enumerate(texts):
+        text = "".join(text.lower().split())
+        for n in range(lo, hi + 1):
+            for i in range(len(text) - n + 1):
+                h = zlib.crc32(text[i:i + n].encode("utf-8"))
+                out[row, h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    np.divide(out, norms, out=out, where=norms > 0)
+    return out
+
+
+##---------------------------------------------------
+## (2) Memory-mapped vector store
+##---------------------------------------------------
+class MmapVectorStore:
+    """Append-only float16 vector store backed by memory-mapped files."""
+
+    def __init__(self, path, dim=DEFAULT_DIM, embed_fn=hash_embed):
+        self.path = path
+        self.embed_fn = embed_fn
+        self._vectors_path = os.path.join(path, "vectors.f16")
+        self._docs_path = os.path.join(path, "docs.jsonl")
+        self._meta_path = os.path.join(path, "meta.json")
+        self._ivf_path = os.path.join(path, "ivf.npz")
+
+        self.dim = dim
+        self.count = 0
+        self.ivf_count = 0
+        self._doc_offsets, self._docs_end = [], 0
+        self._vectors = None
+        self.centroids = None
+        self.ivf_order = None
+        self.ivf_offsets = None
+        self._meta_version = None
+        # refresh() 在别的线程里替换映射和 IVF 时，查询要拿到一组一致的引用（见 _snapshot）
+        self._lock = threading.Lock()
+        self.refresh()
+        if self._vectors is None:
+            self._remap()
+
+    def __len__(self):
+        return self.count
+
+    def refresh(self):
+        """Reload meta.json if it changed on disk (e.g. `python vector_store.py ingest` ran meanwhile)."""
+        try:
+            stat = os.stat(self._meta_path)
+        except FileNotFoundError:
+            return False
+        # meta.json 通过 os.replace 原子替换，inode + mtime 变化即有新提交
+        version = (stat.st_ino, stat.st_mtime_ns)
+        if version == self._meta_version:
+            return False
+        with open(self._meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        # 新的状态先在旁边建好，最后在锁里一次性替换，查询不会看到一半新一半旧的状态
+        dim, count = meta["dim"], meta["count"]
+        # 文档只追加：从上次扫描的位置接着扫新增的行
+        doc_offsets, docs_end = self._scan_doc_offsets(count, self._doc_offsets, self._docs_end)
+        vectors = self._map(count, dim)
+        ivf_count = meta.get("ivf_count", 0)
+        centroids = ivf_order = ivf_offsets = None
+        if ivf_count and os.path.exists(self._ivf_path):
+            with np.load(self._ivf_path) as data:
+                centroids, ivf_order, ivf_offsets = data["centroids"], data["order"], data["offsets"]
+        with self._lock:
+            self.dim, self.count, self._vectors = dim, count, vectors
+            self._doc_offsets, self._docs_end = doc_offsets, docs_end
+            self.ivf_count, self.centroids, self.ivf_order, self.ivf_offsets = ivf_count, centroids, ivf_order, ivf_offsets
+        self._meta_version = version
+        return True
+
+    def _snapshot(self):
+        """(count, vectors, ivf_count, centroids, ivf_order, ivf_offsets) as one consistent set."""
+        with self._lock:
+            return self.count, self._vectors, self.ivf_count, self.centroids, self.ivf_order, self.ivf_offsets
+
+    def _scan_doc_offsets(self, count, offsets=(), pos=0):
+        """Byte offsets of the first `count` lines of docs.jsonl (continuing from `offsets`/`pos`), plus the end offset."""
+        offsets = list(offsets)
+        if os.path.exists(self._docs_path):
+            with open(self._docs_path, "rb") as f:
+                f.seek(pos)
+                for line in f:
+                    if len(offsets) == count:
+                        break
+                    offsets.append(pos)
+                    pos += len(line)
+        return offsets, pos
+
+    def _map(self, count, dim):
+        if count == 0:
+            return np.zeros((0, dim), dtype=np.float16)
+        return np.memmap(self._vectors_path, dtype=np.float16, mode="r", shape=(count, dim))
+
+    def _remap(self):
+        self._vectors = self._map(self.count, self.dim)
+
+    def _write_meta(self):
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "count": self.count, "ivf_count": self.ivf_count}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def add_texts(self, texts, metadatas=None):
+        """Embed and append documents; returns their row ids."""
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = np.asarray(self.embed_fn(texts), dtype=np.float16)
+        if vectors.shape != (len(texts), self.dim):
+            raise ValueError(f"embed_fn returned shape {vectors.shape}, expected {(len(texts), self.dim)}")
+
+        os.makedirs(self.path, exist_ok=True)  # 只在写入时创建目录：只读的服务端不会建空目录
+        # 先截断到 meta 记录的长度，丢弃上次异常中断留下的半截数据
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(self.count * self.dim * 2)
+            f.write(vectors.tobytes())
+        with open(self._docs_path, "ab") as f:
+            f.truncate(self._docs_end)
+            pos = self._docs_end
+            for text, metadata in zip(texts, metadatas):
+                line = (json.dumps({"text": text, "metadata": metadata}, ensure_ascii=False) + "\n").encode("utf-8")
+                self._doc_offsets.append(pos)
+                f.write(line)
+                pos += len(line)
+        first, count = self.count, self.count + len(texts)
+        vectors = self._map(count, self.dim)
+        with self._lock:
+            self._docs_end, self.count, self._vectors = pos, count, vectors
+        self._write_meta()
+        return list(range(first, count))
+
+    def get(self, row):
+        with open(self._docs_path, "rb") as f:
+            f.seek(self._doc_offsets[row])
+            return json.loads(f.readline())
+
+    ##---------------------------------------------------
+    ## IVF coarse partition (optional, for large corpora)
+    ##---------------------------------------------------
+    def build_ivf(self, n_lists=256, n_iter=10, sample_size=100_000, seed=0):
+        """Cluster the current vectors with spherical k-means and persist the partition."""
+        if self.count < n_lists:
+            raise ValueError(f"need at least {n_lists} vectors to build {n_lists} lists, have {self.count}")
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(self.count, size=min(sample_size, self.count), replace=False))
+        sample = np.asarray(self._vectors[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # 空分区保留原质心
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        assign = np.empty(self.count, dtype=np.int32)
+        for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+            block = np.asarray(self._vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+            assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.searchsorted(assign[order], np.arange(n_lists + 1)).astype(np.int64)
+
+        tmp_path = self._ivf_path + ".tmp.npz"
+        np.savez(tmp_path, centroids=centroids.astype(np.float32), order=order, offsets=offsets)
+        os.replace(tmp_path, self._ivf_path)
+        with self._lock:
+            self.centroids, self.ivf_order, self.ivf_offsets = centroids.astype(np.float32), order, offsets
+            self.ivf_count = self.count
+        self._write_meta()
+
+    ##---------------------------------------------------
+    ## Search
+    ##---------------------------------------------------
+    @staticmethod
+    def _candidate_rows(query_vectors, n_probe, count, ivf_count, centroids, ivf_order, ivf_offsets):
+        """Rows from the `n_probe` closest IVF lists plus everything added after the IVF build."""
+        probe = np.argpartition(-(query_vectors @ centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        lists = np.unique(probe)
+        parts = [ivf_order[ivf_offsets[i]:ivf_offsets[i + 1]] for i in lists]
+        parts.append(np.arange(ivf_count, count, dtype=np.int64))
+        return np.sort(np.concatenate(parts))
+
+    def search_vectors(self, query_vectors, k=4, n_probe=None):
+        """Top-k rows for each query vector; returns (rows, scores) arrays of shape (b, k)."""
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        b = len(query_vectors)
+        count, vectors, ivf_count, centroids, ivf_order, ivf_offsets = self._snapshot()
+        k = min(k, count)
+        if k == 0:
+            return np.zeros((b, 0), dtype=np.int64), np.zeros((b, 0), dtype=np.float32)
+
+        if n_probe and centroids is not None:
+            rows = self._candidate_rows(query_vectors, min(n_probe, len(centroids)), count, ivf_count,
+                                        centroids, ivf_order, ivf_offsets)
+            blocks = [(rows, np.asarray(vectors[rows], dtype=np.float32))]
+        else:
+            blocks = (
+                (np.arange(start, min(start + SEARCH_BLOCK_ROWS, count)),
+                 np.asarray(vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32))
+                for start in range(0, count, SEARCH_BLOCK_ROWS)
+            )
+
+        best_rows = np.zeros((b, 0), dtype=np.int64)
+        best_scores = np.zeros((b, 0), dtype=np.float32)
+        for rows, block in blocks:
+            scores = query_vectors @ block.T  # (b, block)
+            kk = min(k, scores.shape[1])
+            top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+            # 和之前各块的 top-k 合并
+            best_rows = np.concatenate([best_rows, rows[top]], axis=1)
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            if best_rows.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def similarity_search(self, queries, k=4, n_probe=None):
+        """Batched text search; returns one list of {"text", "metadata", "score"} per query."""
+        rows, scores = self.search_vectors(self.embed_fn(list(queries)), k=k, n_probe=n_probe)
+        results = []
+        for row_ids, row_scores in zip(rows, scores):
+            hits = []
+            for row, score in zip(row_ids, row_scores):
+                doc = self.get(int(row))
+                doc["score"] = float(score)
+                hits.append(doc)
+            results.append(hits)
+        return results
+
+
+def split_text(text, max_chars=500):
+    """Split text into paragraph-aligned chunks of at most `max_chars` characters."""
+    chunks, current = [], ""
+    for para in (p.strip() for p in text.split("\n\n")):
+        if not para:
+            continue
+        while len(para) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(para[:max_chars])
+            para = para[max_chars:]
+        if current and len(current) + len(para) + 1 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{para}" if current else para
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+if __name__ == "__main__":
+    # python vector_store.py ingest docs/*.md
+    # python vector_store.py build-ivf --lists 256
+    # python vector_store.py query "问题" [--probe 8]
+    # python vector_store.py bench --docs 200000
+    import argparse
+    import tempfile
+    import time
+
+    parser = argparse.ArgumentParser(description="Local memory-mapped vector store")
+    parser.add_argument("command", choices=["ingest", "build-ivf", "query", "bench"])
+    parser.add_argument("args", nargs="*")
+    parser.add_argument("--dir", default=os.environ.get("VECTOR_STORE_DIR", "./vector_store"))
+    parser.add_argument("--lists", type=int, default=256)
+    parser.add_argument("--probe", type=int, default=None)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--docs", type=int, default=200_000)
+    opts = parser.parse_args()
+
+    if opts.command == "bench":
+        with tempfile.TemporaryDirectory() as d:
+            store = MmapVectorStore(d)
+            rng = np.random.default_rng(0)
+            vectors = rng.standard_normal((opts.docs, store.dim), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            store.embed_fn = lambda texts: vectors[:len(texts)]
+            store.add_texts([""] * opts.docs)
+            queries = vectors[rng.choice(opts.docs, size=32)]
+            for label, probe in [("exact", None), ("ivf", 8)]:
+                if probe:
+                    store.build_ivf(n_lists=opts.lists)
+                for batch in (1, len(queries)):
+                    store.search_vectors(queries[:batch], k=opts.k, n_probe=probe)
+                    t0 = time.perf_counter()
+                    store.search_vectors(queries[:batch], k=opts.k, n_probe=probe)
+                    ms = (time.perf_counter() - t0) * 1000
+                    print(f"{label}: {opts.docs} docs, batch={batch}: {ms:.2f} ms ({ms / batch:.2f} ms/query)")
+
+            # 服务端一边 refresh 一边查询：另一个实例追加数据、重建 IVF，查询不能看到半新半旧的状态
+            reader, errors, done = MmapVectorStore(d), [], threading.Event()
+
+            def search_loop():
+                while not done.is_set():
+                    try:
+                        reader.search_vectors(queries[:4], k=opts.k, n_probe=8)
+                    except Exception as e:
+                        errors.append(e)
+                        return
+
+            searcher = threading.Thread(target=search_loop)
+            searcher.start()
+            for _ in range(5):
+                store.add_texts([""] * 1000)
+                store.build_ivf(n_lists=opts.lists)
+                for _ in range(20):
+                    reader.refresh()
+            done.set()
+            searcher.join()
+            assert not errors, errors
+            print(f"refresh while searching: ok ({len(reader)} docs)")
+    else:
+        store = MmapVectorStore(opts.dir)
+        if opts.command == "ingest":
+            for file_path in opts.args:
+                with open(file_path, encoding="utf-8") as f:
+                    chunks = split_text(f.read())
+                store.add_texts(chunks, [{"source": file_path, "chunk": i} for i in range(len(chunks))])
+                print(f"{file_path}: {len(chunks)} chunks")
+            print(f"total: {len(store)} chunks")
+        elif opts.command == "build-ivf":
+            store.build_ivf(n_lists=opts.lists)
+            print(f"IVF built: {opts.lists} lists over {store.ivf_count} vectors")
+        else:
+            for hit in store.similarity_search([" ".join(opts.args)], k=opts.k, n_probe=opts.probe)[0]:
+                print(f"[{hit['score']:.3f}] {hit['metadata']} {hit['text'][:80]!r}")
@@ -4,6 +4,7 @@ import os
 
 ## pip install --upgrade --quiet langchain-community langgraph
 ## pip install -U langchain-deepseek
+## pip install numpy
 from langchain.chat_models import init_chat_model
 from langchain_core.prompts import ChatPromptTemplate
 from typing_extensions import TypedDict
@@ -27,7 +28,20 @@ if "MONGODB_PASSWORD" not in os.environ:
     )
 
 # Initialize chat model
-model = init_chat_model("deepseek-chat", model_provider="deepseek")
+# 菜谱生成按批量任务的最低优先级排队（chatbot/backend/llm_scheduler.py）。只有和聊天服务共用同一组令牌桶才能给
+# 交互式请求让出配额：设置 LLM_SCHEDULER_URL（聊天服务地址）和 ADMIN_TOKEN，在服务端排队
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "chatbot", "backend"))
+from llm_scheduler import BATCH, RemoteScheduler, ScheduledChatModel
+
+if os.environ.get("LLM_SCHEDULER_URL"):
+    scheduler = RemoteScheduler(os.environ["LLM_SCHEDULER_URL"], os.environ.get("ADMIN_TOKEN", ""))
+else:
+    print("LLM_SCHEDULER_URL is not set: rate limiting only within this process, chat traffic is not protected")
+    scheduler = None  # 本进程自己的调度器
+model = ScheduledChatModel(inner=init_chat_model("deepseek-chat", model_provider="deepseek"), priority=BATCH,
+                           scheduler=scheduler)
 
 system_message = """
 你是一个专业的菜谱生成助手。请按照以下步骤处理用户请求：
@@ -61,6 +75,8 @@ class State(TypedDict):
     recipe_json: str
     additional_info_need_to_clarify: str
     technical_issue: str
+    validation_errors: list[str]
+    repair_attempts: int
     answer: str
 
 
@@ -71,6 +87,24 @@ class QueryOutput(TypedDict):
     technical_issue: str  # string, if no technical issue, return empty string
 
 
+# 结构化输出的 runnable 只构建一次，避免每次调用都重新绑定 schema
+structured_llm = model.with_structured_output(QueryOutput)
+
+## define repair prompt: 只把校验错误和原始JSON发给模型，做定向修复
+repair_system_message = """
+你是一个JSON修复助手。下面的菜谱JSON没有通过数据库结构校验。
+请只修复校验错误中列出的问题，不要改动其他字段的内容，并去掉id字段以便MongoDB自动生成。
+校验错误:
+{validation_errors}
+"""
+repair_user_prompt = "菜谱JSON: {recipe_json}"
+
+repair_prompt_template = ChatPromptTemplate(
+    [("system", repair_system_message), ("user", repair_user_prompt)]
+)
+
+MAX_REPAIR_ATTEMPTS = 2
+
 from pymongo import MongoClient
 
 uri = "mongodb://chilema_dev_user:" + os.environ["MONGODB_PASSWORD"] + "@localhost:27017/?authSource=chilema_dev"
@@ -79,9 +113,47 @@ db = mongo_client["chilema_dev"]
 cn = db["recipes"]
 
 
-def get_recipe_samples():
-    """Get a sample of the collection."""
-    samples = cn.find().limit(3)
+def get_recipe_sample_docs(limit=3):
+    """Get raw sample documents of the collection."""
+    return list(cn.find().limit(limit))
+
+
+##---------------------------------------------------
+## Local similarity index over recipe names and ingredients
+##---------------------------------------------------
+from recipe_index import RecipeIndex, recipe_text
+
+RECIPE_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recipe_index.npz")
+
+
+def load_recipe_index():
+    """Load the persisted index and back-fill any recipes it has not seen yet."""
+    index = RecipeIndex(RECIPE_INDEX_PATH)
+    added = 0
+    for doc in cn.find():
+        added += index.add(str(doc["_id"]), recipe_text(doc))
+    if added:
+        index.save()
+    print(f"======> load_recipe_index: {len(index)} recipes ({added} new)")
+    return index
+
+
+recipe_index = load_recipe_index()
+
+
+def get_recipe_samples(recipe_name="", additional_desc=""):
+    """Get the recipes most similar to the request, falling back to the first ones."""
+    samples = []
+    hits = recipe_index.search(f"{recipe_name} {additional_desc}", k=3)
+    if hits:
+        from bson import ObjectId
+
+        ids = [doc_id for doc_id, _ in hits]
+        object_ids = [ObjectId(doc_id) if ObjectId.is_valid(doc_id) else doc_id for doc_id in ids]
+        docs_by_id = {str(doc["_id"]): doc for doc in cn.find({"_id": {"$in": object_ids}})}
+        samples = [docs_by_id[doc_id] for doc_id in ids if doc_id in docs_by_id]
+    if not samples:
+        samples = get_recipe_sample_docs()
     if not samples:
         return ['{}', '{}', '{}']
     sample_list = []
@@ -93,9 +165,102 @@ def get_recipe_samples():
     return sample_list
 
 
+##---------------------------------------------------
+## Recipe schema: derived from the collection's examples and compiled once
+##---------------------------------------------------
+def _json_type(value):
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list):
+        return "array"
+    if isinstance(value, dict):
+        return "object"
+    if value is None:
+        return "null"
+    # ObjectId / datetime 等 BSON 类型在生成的JSON里只能是字符串
+    return "string"
+
+
+def infer_schema(values):
+    """Infer a JSON-schema-like dict that accepts every value in `values`."""
+    types = {_json_type(v) for v in values}
+    schema = {"type": sorted(types)}
+    objects = [v for v in values if isinstance(v, dict)]
+    if objects:
+        keys = set().union(*objects)
+        keys.discard("_id")
+        schema["properties"] = {
+            key: infer_schema([o[key] for o in objects if key in o]) for key in sorted(keys)
+        }
+        schema["required"] = sorted(k for k in keys if all(k in o for o in objects))
+    items = [item for v in values if isinstance(v, list) for item in v]
+    if items:
+        schema["items"] = infer_schema(items)
+    return schema
+
+
+def compile_schema(schema, path="$"):
+    """
+    把schema编译成嵌套的校验函数，校验时不再解释schema字典。
+    返回的函数接收一个值，返回错误信息列表（为空则表示通过）。
+    """
+    allowed = frozenset(schema["type"])
+    properties = {
+        key: compile_schema(sub, f"{path}.{key}") for key, sub in schema.get("properties", {}).items()
+    }
+    required = tuple(schema.get("required", ()))
+    check_items = compile_schema(schema["items"], f"{path}[]") if "items" in schema else None
+
+    def validate(value):
+        actual = _json_type(value)
+        if actual not in allowed:
+            return [f"{path}: 类型应为 {'/'.join(sorted(allowed))}，实际为 {actual}"]
+        errors = []
+        if actual == "object":
+            errors.extend(f"{path}.{key}: 缺少必需字段" for key in required if key not in value)
+            for key, check in properties.items():
+                if key in value:
+                    errors.extend(check(value[key]))
+        elif actual == "array" and check_items is not None:
+            for item in value:
+                errors.extend(check_items(item))
+        return errors
+
+    return validate
+
+
+_recipe_validator = None
+
+
+def get_recipe_validator():
+    """Build the recipe validator from the collection's examples on first use."""
+    global _recipe_validator
+    if _recipe_validator is None:
+        docs = get_recipe_sample_docs()
+        if docs:
+            _recipe_validator = compile_schema(infer_schema(docs))
+        else:
+            # 集合为空时无法推断结构，只要求是一个JSON对象
+            _recipe_validator = compile_schema({"type": ["object"]})
+    return _recipe_validator
+
+
+def validate_recipe_json(recipe_json: str):
+    """Return a list of validation errors for the generated recipe JSON string."""
+    try:
+        recipe = json.loads(recipe_json)
+    except json.JSONDecodeError as e:
+        return [f"$: 不是合法的JSON ({e})"]
+    return get_recipe_validator()(recipe)
+
+
 def lc_write_recipe_query(state: State):
-    sample_list = get_recipe_samples()
     """Generate SQL query to fetch information."""
+    sample_list = get_recipe_samples(state["recipe_name"], state.get("additional_desc", ""))
     prompt = query_prompt_template.invoke(
         {
             "input_recipe_sample_1": sample_list[0],
@@ -105,67 +270,107 @@ def lc_write_recipe_query(state: State):
             "input_additional_desc": state.get("additional_desc", ""),
         }
     )
-    structured_llm = model.with_structured_output(QueryOutput)
     res = structured_llm.invoke(prompt)
     print("======> lc_write_recipe_query: " + str(res))
     return {
         "recipe_json": res["recipe_json"],
         "additional_info_need_to_clarify": res["additional_info_need_to_clarify"],
-        "technical_issue": res["technical_issue"]
+        "technical_issue": res["technical_issue"],
+        "repair_attempts": 0
     }
 
 
+def lc_validate_recipe(state: State):
+    """Validate the generated recipe against the compiled collection schema."""
+    if state["additional_info_need_to_clarify"] or state["technical_issue"] or not state["recipe_json"]:
+        return {"validation_errors": []}
+    errors = validate_recipe_json(state["recipe_json"])
+    print("======> lc_validate_recipe: " + (str(errors) if errors else "OK"))
+    return {"validation_errors": errors}
+
+
+def lc_repair_recipe(state: State):
+    """Ask the model to fix only the reported validation errors."""
+    prompt = repair_prompt_template.invoke(
+        {
+            "validation_errors": "\n".join(state["validation_errors"]),
+            "recipe_json": state["recipe_json"],
+        }
+    )
+    res = structured_llm.invoke(prompt)
+    print("======> lc_repair_recipe: " + str(res))
+    return {
+        "recipe_json": res["recipe_json"],
+        "technical_issue": res["technical_issue"],
+        "repair_attempts": state.get("repair_attempts", 0) + 1
+    }
+
+
+def route_after_validation(state: State):
+    """Repair invalid output until the attempt budget is used up."""
+    if not state.get("validation_errors"):
+        return "lc_insert_recipe"
+    if state.get("repair_attempts", 0) < MAX_REPAIR_ATTEMPTS:
+        return "lc_repair_recipe"
+    return "lc_insert_recipe"
+
+
 def lc_insert_recipe(state: State):
     """Insert a recipe into the collection."""
     if state["additional_info_need_to_clarify"]:
         return {"recipe_id": ""}
     if state["technical_issue"]:
         return {"recipe_id": ""}
+    if state.get("validation_errors"):
+        return {"recipe_id": "", "technical_issue": "生成的菜谱未通过结构校验: " + "; ".join(state["validation_errors"])}
     try:
         recipe_json = state["recipe_json"]
         if not recipe_json:
             return {"recipe_id": ""}
-        result = cn.insert_one(json.loads(recipe_json))
+        recipe = json.loads(recipe_json)
+        result = cn.insert_one(recipe)
         recipe_id = result.inserted_id
+        # 新菜谱增量加入相似度索引并落盘
+        if recipe_index.add(str(recipe_id), recipe_text(recipe)):
+            recipe_index.save()
         return {"recipe_id": str(recipe_id)}
     except Exception as e:
         return {"recipe_id": "", "technical_issue": str(e)}
 
 
 def lc_generate_answer(state: State):
-    """Answer question using retrieved information as context."""
-    prompt = (
-        '''
-        如果完成了菜谱生成，并且已经把菜谱存入数据库，请回复:
-        菜谱已成功生成并存入数据库
-        ID: {recipe_id}
-        内容: {recipe_json}
-        '''
-        '''
-        如果需要澄清更多信息，请回复:
-        需要澄清以下信息以生成菜谱: {additional_info_need_to_clarify}
-        '''
-        '''
-        如果遇到技术问题，请回复:
-        遇到技术问题: {technical_issue}
-        '''
-    ).format(
-        recipe_id=state.get("recipe_id", ""),
-        recipe_json=state.get("recipe_json", ""),
-        additional_info_need_to_clarify=state.get("additional_info_need_to_clarify", ""),
-        technical_issue=state.get("technical_issue", "")
-    )
-    response = model.invoke(prompt)
-    return {"answer": response}
+    """Render the final answer locally from the pipeline state (no LLM call)."""
+    if state.get("recipe_id"):
+        answer = (
+            "菜谱已成功生成并存入数据库\n"
+            f"ID: {state['recipe_id']}\n"
+            f"内容: {state.get('recipe_json', '')}"
+        )
+    elif state.get("additional_info_need_to_clarify"):
+        answer = f"需要澄清以下信息以生成菜谱: {state['additional_info_need_to_clarify']}"
+    elif state.get("technical_issue"):
+        answer = f"遇到技术问题: {state['technical_issue']}"
+    else:
+        answer = "遇到技术问题: 未生成任何菜谱内容"
+    return {"answer": answer}
 
 
 ## Use LangGraph to orchestrate the steps
 from langgraph.graph import START, StateGraph
 
 graph_builder = StateGraph(State).add_sequence(
-    [lc_write_recipe_query, lc_insert_recipe, lc_generate_answer]
+    [lc_write_recipe_query, lc_validate_recipe]
 )
+graph_builder.add_node(lc_repair_recipe)
+graph_builder.add_sequence([lc_insert_recipe, lc_generate_answer])
 graph_builder.add_edge(START, "lc_write_recipe_query")
+# 校验失败 -> 定向修复 -> 重新校验；通过或修复次数用完 -> 入库
+graph_builder.add_conditional_edges(
+    "lc_validate_recipe",
+    route_after_validation,
+    {"lc_repair_recipe": "lc_repair_recipe", "lc_insert_recipe": "lc_insert_recipe"}
+)
+graph_builder.add_edge("lc_repair_recipe", "lc_validate_recipe")
 graph = graph_builder.compile()
 
 # from IPython.display import Image, display
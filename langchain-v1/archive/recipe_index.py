@@ -0,0 +1,176 @@
+## pip install numpy
+"""
+本地菜谱相似度索引：字符 n-gram TF-IDF + 倒排表。
+
+- 每个 n-gram 对应一条 posting（文档下标 + 归一化后的 tf 权重），用 `array` 追加，
+  查询时通过 `np.frombuffer` 零拷贝转成 NumPy 数组再做向量化累加。
+- IDF 在查询时按当前文档频率计算，所以插入新菜谱只需追加 posting，不用重建索引。
+- 索引以 .npz 持久化到磁盘（CSR 结构），写入时先写临时文件再原子替换。
+"""
+import json
+import math
+import os
+from array import array
+
+import numpy as np
+
+RECIPE_TEXT_FIELDS = ("name", "title", "recipe_name", "ingredients")
+
+
+def recipe_text(doc: dict) -> str:
+    """Concatenate the name and ingredient fields of a recipe document."""
+    parts = []
+
+    def collect(value):
+        if isinstance(value, dict):
+            for v in value.values():
+                collect(v)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                collect(v)
+        elif value is not None:
+            parts.append(str(value))
+
+    for field in RECIPE_TEXT_FIELDS:
+        if field in doc:
+            collect(doc[field])
+    return " ".join(parts)
+
+
+def char_ngrams(text: str, ngram_range=(1, 3)) -> dict:
+    """Count character n-grams of `text`, ignoring whitespace."""
+    text = "".join(text.lower().split())
+    counts = {}
+    lo, hi = ngram_range
+    for n in range(lo, hi + 1):
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+
+class RecipeIndex:
+    """Incremental char n-gram TF-IDF index over recipe names and ingredients."""
+
+    def __init__(self, path=None, ngram_range=(1, 3)):
+        self.path = path
+        self.ngram_range = tuple(ngram_range)
+        self.ids = []  # 文档下标 -> 外部ID（MongoDB _id 字符串）
+        self.id_set = set()
+        self.vocab = {}  # n-gram -> posting 下标
+        self.post_docs = []  # array('i')，每个 n-gram 的文档下标
+        self.post_weights = []  # array('f')，对应的 tf 权重
+        self._scores = np.zeros(0, dtype=np.float32)
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, doc_id: str, text: str) -> bool:
+        """Append one document; returns False if `doc_id` is already indexed."""
+        doc_id = str(doc_id)
+        if doc_id in self.id_set:
+            return False
+        counts = char_ngrams(text, self.ngram_range)
+        doc = len(self.ids)
+        self.ids.append(doc_id)
+        self.id_set.add(doc_id)
+        if not counts:
+            return True
+        # 次线性 tf，再做 L2 归一化，长菜谱不会因为字多而占优
+        weights = {g: 1.0 + math.log(c) for g, c in counts.items()}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        for gram, w in weights.items():
+            term = self.vocab.get(gram)
+            if term is None:
+                term = self.vocab[gram] = len(self.post_docs)
+                self.post_docs.append(array("i"))
+                self.post_weights.append(array("f"))
+            self.post_docs[term].append(doc)
+            self.post_weights[term].append(w / norm)
+        return True
+
+    def search(self, text: str, k: int = 3):
+        """Return up to `k` (doc_id, score) pairs, most similar first."""
+        n_docs = len(self.ids)
+        if n_docs == 0 or k <= 0:
+            return []
+        if self._scores.shape[0] < n_docs:
+            self._scores = np.zeros(max(n_docs, 2 * self._scores.shape[0]), dtype=np.float32)
+        scores = self._scores[:n_docs]
+        scores.fill(0.0)
+        for gram, count in char_ngrams(text, self.ngram_range).items():
+            term = self.vocab.get(gram)
+            if term is None:
+                continue
+            docs = np.frombuffer(self.post_docs[term], dtype=np.int32)
+            weights = np.frombuffer(self.post_weights[term], dtype=np.float32)
+            # 查询侧权重 = 次线性 tf * idf²（文档侧不含 idf，所以插入时无需重算）
+            idf = math.log((n_docs + 1) / (len(docs) + 1)) + 1.0
+            scores[docs] += weights * np.float32((1.0 + math.log(count)) * idf * idf)
+        k = min(k, n_docs)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.ids[i], float(scores[i])) for i in top if scores[i] > 0]
+
+    def save(self, path=None):
+        """Persist the index as a CSR-style .npz file (atomic replace)."""
+        path = path or self.path
+        lengths = np.fromiter((len(p) for p in self.post_docs), dtype=np.int64, count=len(self.post_docs))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        docs = np.concatenate([np.frombuffer(p, dtype=np.int32) for p in self.post_docs]) \
+            if self.post_docs else np.zeros(0, dtype=np.int32)
+        weights = np.concatenate([np.frombuffer(p, dtype=np.float32) for p in self.post_weights]) \
+            if self.post_weights else np.zeros(0, dtype=np.float32)
+        meta = {"ngram_range": list(self.ngram_range), "ids": self.ids, "terms": list(self.vocab)}
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, offsets=offsets, docs=docs, weights=weights,
+                 meta=np.frombuffer(json.dumps(meta, ensure_ascii=False).encode("utf-8"), dtype=np.uint8))
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with np.load(path) as data:
+            meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+            offsets, docs, weights = data["offsets"], data["docs"], data["weights"]
+        self.ngram_range = tuple(meta["ngram_range"])
+        self.ids = meta["ids"]
+        self.id_set = set(self.ids)
+        self.vocab = {gram: i for i, gram in enumerate(meta["terms"])}
+        self.post_docs = [array("i", docs[offsets[i]:offsets[i + 1]].tobytes()) for i in range(len(self.vocab))]
+        self.post_weights = [array("f", weights[offsets[i]:offsets[i + 1]].tobytes()) for i in range(len(self.vocab))]
+
+
+if __name__ == "__main__":
+    # 简单基准：几万条合成菜名下的查询延迟
+    import random
+    import tempfile
+    import time
+
+    random.seed(0)
+    chars = "红烧清蒸糖醋宫保麻辣香酥干煸油焖鸡鸭鱼肉虾蟹豆腐茄子土豆排骨牛羊丁片丝块汤面饭"
+    index = RecipeIndex()
+    t0 = time.perf_counter()
+    for i in range(50000):
+        name = "".join(random.choice(chars) for _ in range(random.randint(3, 6)))
+        ingredients = " ".join(random.choice(chars) * 2 for _ in range(5))
+        index.add(f"id{i}", f"{name} {ingredients}")
+    print(f"build: {len(index)} docs, {len(index.vocab)} terms, {time.perf_counter() - t0:.2f}s")
+
+    queries = ["红烧鸡块", "清蒸鱼", "麻辣豆腐", "糖醋排骨", "土豆牛肉"]
+    for q in queries:
+        index.search(q)
+    n = 2000
+    t0 = time.perf_counter()
+    for i in range(n):
+        index.search(queries[i % len(queries)], k=3)
+    print(f"search: {(time.perf_counter() - t0) / n * 1e6:.1f} us/query")
+    print(queries[0], index.search(queries[0]))
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "recipe_index.npz")
+        index.save(path)
+        reloaded = RecipeIndex(path)
+        assert reloaded.search(queries[0]) == index.search(queries[0])
+        print(f"save/load ok: {os.path.getsize(path) / 1e6:.1f} MB")